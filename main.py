@@ -24,12 +24,13 @@
 import sys
 
 # Import PyQt5 modules
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 
 # Import Coublet modules
 from models.cache import CACHE
 from models.app import CoubletAppModel
-from models.com import set_user_agent
+from models.com import set_user_agent, TRAFFIC_BACKGROUND
 from presenters.window import CoubletWindowPresenter
 from views.vars import set_gui_constants, DEFAULT_WINDOW_POS_DIM
 
@@ -37,6 +38,13 @@ from views.vars import set_gui_constants, DEFAULT_WINDOW_POS_DIM
 # TODO: read version from file (where will VERSION file be in the final app?)
 VERSION = 0, 6, 95
 DEV = 0
+# Download engines: 'threads' or 'asyncio' (select by --engine=asyncio)
+ENGINE = 'threads'
+# Address of the API (select a local stand-in server by --api=<url>)
+API = None
+# KiB/s budget of background traffic, like syncs, updates and pages fetched
+# ahead (select by --bandwidth=<KiB/s>, 0 is unlimited, None is the default)
+BANDWIDTH = None
 
 #------------------------------------------------------------------------------#
 class CoubletApp(QApplication):
@@ -44,7 +52,8 @@ class CoubletApp(QApplication):
     NAME = 'coublet'
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, version, *args, **kwargs):
+    def __init__(self, version, engine=ENGINE, api=API, bandwidth=BANDWIDTH,
+                 *args, **kwargs):
         super().__init__(sys.argv, *args, **kwargs)
         # Set name of app
         self.setApplicationName(self.NAME)
@@ -56,7 +65,19 @@ class CoubletApp(QApplication):
         set_user_agent(self.NAME, version)
         CACHE.load(version, DEFAULT_WINDOW_POS_DIM)
 
-        self._model = CoubletAppModel()
+        # Create the selected download engine
+        if engine == 'asyncio':
+            # Import Coublet modules
+            from models.aio import DOWNLOADS
+            # Stop the event loop of the engine before the application quits
+            self.aboutToQuit.connect(DOWNLOADS.close)
+        else:
+            # Import Coublet modules
+            from models.com import DOWNLOADS
+
+        self._model = CoubletAppModel(DOWNLOADS, api)
+        if bandwidth is not None:
+            self._model.set_bandwidth(TRAFFIC_BACKGROUND, bandwidth*1024)
         self._presenter = CoubletWindowPresenter(self._model, self.NAME)
 
         # Start auto-saving
@@ -68,6 +89,8 @@ class CoubletApp(QApplication):
         # TODO: catch all exceptions, store it to a log file, write that into
         #       the cache file and ask the user if he wants to send it to us
         self._presenter.show_view()
+        # Check the cache folders once the first frame of the window is drawn
+        QTimer.singleShot(0, CACHE.purge)
         return self.exec_()
         # # Print all module dependencies
         # print(*['{}: {}'.format(k, v) for k, v in sys.modules.items()], sep='\n')
@@ -77,6 +100,17 @@ class CoubletApp(QApplication):
 #==============================================================================#
 if __name__ == '__main__':
     version = VERSION
+    # Get the selected download engine, API address and bandwidth
+    engine = ENGINE
+    api = API
+    bandwidth = BANDWIDTH
+    for argument in sys.argv[1:]:
+        if argument.startswith('--engine='):
+            engine = argument.split('=', 1)[1]
+        elif argument.startswith('--api='):
+            api = argument.split('=', 1)[1]
+        elif argument.startswith('--bandwidth='):
+            bandwidth = int(argument.split('=', 1)[1])
     if DEV:
         # Import cutils modules
         import cutils.ccom
@@ -92,4 +126,4 @@ if __name__ == '__main__':
         # Update header comments
         cutils.clic.header('.', exceptions=exceptions)
     # Run application
-    sys.exit(CoubletApp(version).run())
+    sys.exit(CoubletApp(version, engine, api, bandwidth).run())
@@ -0,0 +1,469 @@
+## INFO ########################################################################
+##                                                                            ##
+##                                  COUBLET                                   ##
+##                                  =======                                   ##
+##                                                                            ##
+##          Cross-platform desktop client to follow posts from COUB           ##
+##                       Version: 0.6.93.193 (20140824)                       ##
+##                                                                            ##
+##                            File: mock/server.py                            ##
+##                                                                            ##
+##           Designed and written by Peter Varo. Copyright (c) 2014           ##
+##             License agreement is provided in the LICENSE file              ##
+##           For more info visit: https://github.com/petervaro/coub           ##
+##                                                                            ##
+##      Copyright (c) 2014 Coub Ltd and/or its suppliers and licensors,       ##
+##    5 Themistokli Dervi Street, Elenion Building, 1066 Nicosia, Cyprus.     ##
+##         All rights reserved. COUB (TM) is a trademark of Coub Ltd.         ##
+##                              http://coub.com                               ##
+##                                                                            ##
+######################################################################## INFO ##
+
+# Local stand-in of the COUB API, to measure and test the client offline
+#
+# serve fixtures (recorded ones if there are any, synthesised ones otherwise):
+#     python3 -m mock.server serve --port=8080 --latency=0.2 --bandwidth=65536
+#     python3 main.py --api=http://127.0.0.1:8080
+#
+# record fixtures from the real API:
+#     python3 -m mock.server record --pages=2 --per-page=5
+
+# Import Python modules
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import hashlib
+import argparse
+import itertools
+import email.utils
+import http.server
+import urllib.parse
+import urllib.request
+
+# Import Coublet modules
+from models.api import CoubAPI, _ruby_format
+
+# Module level constants
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# Placeholder of the address of the server in recorded fixtures
+BASE = '{BASE}'
+# Sizes of the synthesised data
+TOTAL_POSTS = 50
+COUB_POOL = 500
+USER_POOL = 50
+MEDIA_SIZES = {'videos' : 512*1024,
+               'thumbs' : 16*1024,
+               'avatars': 4*1024,
+               'audio'  : 128*1024}
+MEDIA_TYPES = {'.json': 'application/json',
+               '.mp4' : 'video/mp4',
+               '.jpg' : 'image/jpeg',
+               '.png' : 'image/png',
+               '.mp3' : 'audio/mpeg'}
+CHUNK_SIZE = 16*1024
+ERRORS = 500, 502, 503
+
+#------------------------------------------------------------------------------#
+def _get_number(*values):
+    # Return a stable number from values
+    digest = hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16)
+
+
+#------------------------------------------------------------------------------#
+def _localise(url):
+    # Return the address of an URL on the stand-in server
+    parts = urllib.parse.urlsplit(url)
+    return '{}/media/{}{}'.format(BASE, parts.netloc, parts.path)
+
+
+#------------------------------------------------------------------------------#
+def _fetch(url):
+    print('[ MOCK ] Recording {!r}'.format(url))
+    with urllib.request.urlopen(url) as respond:
+        return respond.read()
+
+
+#------------------------------------------------------------------------------#
+def _write(file, data):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'wb') as output:
+        output.write(data)
+
+
+#------------------------------------------------------------------------------#
+def record(root, source, pages, per_page):
+    # Record the first pages of each stream, and everything they refer to
+    for stream in CoubAPI.STREAM_JSONS:
+        name = stream[:-len('.json')]
+        for page in range(1, pages + 1):
+            url = CoubAPI.STREAM_URL.format(source, stream, page, per_page)
+            data = json.loads(_fetch(url).decode('utf-8'))
+            for coub in data.get('coubs', ()):
+                _record_coub(root, coub)
+            file = os.path.join(root, 'timeline', name, '{}.json'.format(page))
+            _write(file, json.dumps(data).encode('utf-8'))
+
+
+#------------------------------------------------------------------------------#
+def _record_coub(root, coub):
+    # Download the media files the client is using, and point the URLs of the
+    # coub to the stand-in server (templates will be expanded by the client)
+    try:
+        image = coub['image_versions']
+        _record_media(root, _ruby_format(image['template'], version='small'))
+        image['template'] = _localise(image['template'])
+    except KeyError:
+        pass
+    try:
+        video = coub['file_versions']['web']
+        _record_media(root, _ruby_format(video['template'], version='small', type='mp4'))
+        video['template'] = _localise(video['template'])
+    except KeyError:
+        pass
+    try:
+        user = coub['user']
+        _record_media(root, user['small_avatar'])
+        user['small_avatar'] = _localise(user['small_avatar'])
+    except (KeyError, TypeError):
+        pass
+    if coub.get('audio_file_url'):
+        _record_media(root, coub['audio_file_url'])
+        coub['audio_file_url'] = _localise(coub['audio_file_url'])
+    # Store coub for the update requests
+    if coub.get('permalink'):
+        file = os.path.join(root, 'coubs', coub['permalink'] + '.json')
+        _write(file, json.dumps(coub).encode('utf-8'))
+
+
+#------------------------------------------------------------------------------#
+def _record_media(root, url):
+    parts = urllib.parse.urlsplit(url)
+    file = os.path.join(root, 'media', parts.netloc, *parts.path.split('/'))
+    if not os.path.isfile(file):
+        _write(file, _fetch(url))
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMockFixtures:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, root, total_posts):
+        # Store static values
+        self._root = os.path.abspath(root)
+        self._total_posts = total_posts
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_timeline(self, name, page, per_page, base):
+        # Pages of any size are cut from the same stream by position (as they
+        # are on the real API), if stream has been recorded, from its coubs
+        offset = (page - 1)*per_page
+        recorded = self._load_timeline(name, base)
+        if recorded:
+            total_posts = len(recorded)
+            coubs = recorded[offset:offset + per_page]
+        # Synthesise a page of coubs, which are overlapping between streams,
+        # and where a coub depends on its position only
+        else:
+            total_posts = self._total_posts
+            coubs = []
+            for position in range(offset, min(offset + per_page, total_posts)):
+                id = _get_number(name, position) % COUB_POOL
+                coubs.append(self._synthesise_coub(id, base))
+        data = {'page'       : page,
+                'per_page'   : per_page,
+                'total_pages': -(-total_posts//per_page),
+                'coubs'      : coubs}
+        return json.dumps(data).encode('utf-8')
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_coub(self, permalink, base):
+        # If coub has been recorded
+        try:
+            return self._load(base, 'coubs', permalink + '.json')
+        except FileNotFoundError:
+            pass
+        # Synthesise coub
+        try:
+            id = int(permalink[4:] if permalink.startswith('mock') else permalink)
+        except ValueError:
+            id = _get_number(permalink) % COUB_POOL
+        return json.dumps(self._synthesise_coub(id, base)).encode('utf-8')
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_media(self, path):
+        # If media has been recorded
+        try:
+            with open(self._get_file('media', *path.split('/')), 'rb') as file:
+                return file.read()
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+        # Synthesise some stable garbage of the size of the media kind
+        kind = path.split('/', 1)[0]
+        size = MEDIA_SIZES.get(kind, CHUNK_SIZE)
+        block = hashlib.sha1(path.encode('utf-8')).digest()
+        return (block*(size//len(block) + 1))[:size]
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _load_timeline(self, name, base):
+        # Return the coubs of the recorded pages of stream in order
+        coubs = []
+        for page in itertools.count(1):
+            try:
+                data = self._load(base, 'timeline', name, '{}.json'.format(page))
+            except FileNotFoundError:
+                return coubs
+            coubs.extend(json.loads(data.decode('utf-8')).get('coubs', ()))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _load(self, base, *path):
+        with open(self._get_file(*path), encoding='utf-8') as file:
+            return file.read().replace(BASE, base).encode('utf-8')
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_file(self, *path):
+        # Do not let requests leave the folder of fixtures
+        file = os.path.normpath(os.path.join(self._root, *path))
+        if not file.startswith(self._root + os.sep):
+            raise FileNotFoundError(file)
+        return file
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _synthesise_coub(self, id, base):
+        user = _get_number('user', id) % USER_POOL
+        media = base + '/media'
+        return {'id'            : id,
+                'permalink'     : 'mock{}'.format(id),
+                'title'         : 'Mock coub #{}'.format(id),
+                'likes_count'   : _get_number('likes', id) % 1000,
+                'recoubs_count' : _get_number('recoubs', id) % 100,
+                'dimensions'    : {'small': [640, 360]},
+                'audio_file_url': '{}/audio/{}.mp3'.format(media, id),
+                'image_versions': {'template': '{}/thumbs/{}/%{{version}}.jpg'.format(media, id),
+                                   'versions': ['small', 'med', 'big']},
+                'file_versions' : {'web': {'template': '{}/videos/{}/%{{version}}.%{{type}}'.format(media, id),
+                                           'versions': ['small', 'big'],
+                                           'types'   : ['mp4']}},
+                'user'          : {'id'          : user,
+                                   'name'        : 'Mock user #{}'.format(user),
+                                   'permalink'   : 'mockuser{}'.format(user),
+                                   'small_avatar': '{}/avatars/{}.jpg'.format(media, user)}}
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMockServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, address, fixtures, latency=0, jitter=0, bandwidth=0,
+                 error_rate=0, drop_rate=0, conditional=True, ranges=True,
+                 compress=True):
+        super().__init__(address, CoubletMockHandler)
+        # Store static values
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.conditional = conditional
+        self.ranges = ranges
+        self.compress = compress
+        self.modified = email.utils.formatdate(usegmt=True)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMockHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def do_GET(self):
+        server = self.server
+        # Simulate the latency of the network
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        # Simulate a failing server
+        if random.random() < server.error_rate:
+            self._send_empty(random.choice(ERRORS))
+            return
+
+        # Get data by the shape of the URL
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        path = urllib.parse.unquote(parts.path)
+        base = 'http://' + self.headers.get('Host', '{}:{}'.format(*server.server_address[:2]))
+        fixtures = server.fixtures
+        try:
+            if path.startswith('/api/v1/timeline/') and path.endswith('.json'):
+                data = fixtures.get_timeline(path[17:-5],
+                                             int(query.get('page', ['1'])[0]),
+                                             max(1, int(query.get('per_page', ['10'])[0])),
+                                             base)
+            elif path.startswith('/coubs/') and path.endswith('.json'):
+                data = fixtures.get_coub(path[7:-5], base)
+            elif path.startswith('/media/'):
+                data = fixtures.get_media(path[7:])
+            else:
+                raise FileNotFoundError(path)
+        except FileNotFoundError:
+            self._send_empty(404)
+            return
+        except ValueError:
+            self._send_empty(400)
+            return
+        self._send_data(data, MEDIA_TYPES.get(os.path.splitext(path)[1],
+                                              'application/octet-stream'))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def log_message(self, format, *args):
+        print('[ MOCK ] ' + format % args)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _send_data(self, data, content_type):
+        server = self.server
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest()[:16])
+
+        # If client has the same data already
+        if server.conditional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        # If client asks for the rest of the data only
+        status, headers = 200, {}
+        span = self.headers.get('Range')
+        if (server.ranges and span and span.startswith('bytes=') and
+            self.headers.get('If-Range', etag) in (etag, server.modified)):
+                start, _, end = span[6:].partition('-')
+                start = int(start or 0)
+                end = min(int(end or len(data) - 1), len(data) - 1)
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+                status, data = 206, data[start:end + 1]
+        # If data can be sent compressed
+        elif (server.compress and content_type == 'application/json' and
+              'gzip' in self.headers.get('Accept-Encoding', '')):
+                headers['Content-Encoding'] = 'gzip'
+                data = gzip.compress(data)
+
+        # Send headers
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', server.modified)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        for header in headers.items():
+            self.send_header(*header)
+        self.end_headers()
+
+        # Simulate a connection lost in the middle of the transfer
+        if random.random() < server.drop_rate:
+            data = data[:len(data)//2]
+            self.close_connection = True
+        # Send body, not faster than the bandwidth
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk)/server.bandwidth)
+
+
+
+#------------------------------------------------------------------------------#
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python3 -m mock.server',
+                                     description='Local stand-in of the COUB API')
+    parser.add_argument('--fixtures', default=FIXTURES,
+                        help='folder of recorded fixtures')
+    commands = parser.add_subparsers(dest='command')
+
+    # Options of serving
+    serve = commands.add_parser('serve', help='serve fixtures')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--posts', type=int, default=TOTAL_POSTS,
+                       help='number of synthesised posts of each stream')
+    serve.add_argument('--latency', type=float, default=0,
+                       help='seconds before each respond')
+    serve.add_argument('--jitter', type=float, default=0,
+                       help='random seconds added to latency')
+    serve.add_argument('--bandwidth', type=int, default=0,
+                       help='bytes/sec of each connection (0 means unlimited)')
+    serve.add_argument('--error-rate', type=float, default=0,
+                       help='ratio of requests failing with 5xx')
+    serve.add_argument('--drop-rate', type=float, default=0,
+                       help='ratio of responds cut in half')
+    serve.add_argument('--no-conditional', dest='conditional', action='store_false',
+                       help='never respond with 304')
+    serve.add_argument('--no-ranges', dest='ranges', action='store_false',
+                       help='ignore Range requests')
+    serve.add_argument('--no-compress', dest='compress', action='store_false',
+                       help='never compress JSON')
+
+    # Options of recording
+    rec = commands.add_parser('record', help='record fixtures from the real API')
+    rec.add_argument('--source', default=CoubAPI.BASE_URL)
+    rec.add_argument('--pages', type=int, default=1)
+    rec.add_argument('--per-page', type=int, default=5)
+
+    options = parser.parse_args(arguments)
+    if options.command == 'record':
+        record(options.fixtures, options.source, options.pages, options.per_page)
+        return
+
+    # Serve until interrupted
+    if options.command is None:
+        options = parser.parse_args((arguments or sys.argv[1:]) + ['serve'])
+    server = CoubletMockServer((options.host, options.port),
+                               CoubletMockFixtures(options.fixtures, options.posts),
+                               options.latency, options.jitter, options.bandwidth,
+                               options.error_rate, options.drop_rate,
+                               options.conditional, options.ranges, options.compress)
+    print('[ MOCK ] Serving COUB API on {}'.format(server.get_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+
+#==============================================================================#
+if __name__ == '__main__':
+    main()
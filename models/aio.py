@@ -0,0 +1,521 @@
+## INFO ########################################################################
+##                                                                            ##
+##                                  COUBLET                                   ##
+##                                  =======                                   ##
+##                                                                            ##
+##          Cross-platform desktop client to follow posts from COUB           ##
+##                       Version: 0.6.93.193 (20140824)                       ##
+##                                                                            ##
+##                            File: models/aio.py                             ##
+##                                                                            ##
+##           Designed and written by Peter Varo. Copyright (c) 2014           ##
+##             License agreement is provided in the LICENSE file              ##
+##           For more info visit: https://github.com/petervaro/coub           ##
+##                                                                            ##
+##      Copyright (c) 2014 Coub Ltd and/or its suppliers and licensors,       ##
+##    5 Themistokli Dervi Street, Elenion Building, 1066 Nicosia, Cyprus.     ##
+##         All rights reserved. COUB (TM) is a trademark of Coub Ltd.         ##
+##                              http://coub.com                               ##
+##                                                                            ##
+######################################################################## INFO ##
+
+# Import Python modules
+import io
+import ssl
+import heapq
+import asyncio
+import itertools
+import threading
+import contextlib
+import http.client
+import urllib.error
+import urllib.parse
+
+# Import Coublet modules
+from models.com import (CHUNK_SIZE,
+                        RETRIES,
+                        FLIGHTS,
+                        BREAKERS,
+                        BANDWIDTH,
+                        REDIRECTS,
+                        READ_TIMEOUT,
+                        MAX_REDIRECTS,
+                        CONNECT_TIMEOUT,
+                        CONNECTIONS_PER_HOST,
+                        TRAFFIC_INTERACTIVE,
+                        CoubletCancelled,
+                        CoubletContentDecoder,
+                        _is_failure,
+                        _is_pending,
+                        _start_save,
+                        _abort_save,
+                        _get_respond,
+                        _finish_save,
+                        _get_retry_delay,
+                        _restart_partial,
+                        _get_request_headers)
+
+# Module level constants
+CONCURRENCY = 64
+
+#------------------------------------------------------------------------------#
+async def _on_disk(function, *args):
+    # Files are used by the threads of the executor, so
+    # the transfers of the loop never wait for them
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+#------------------------------------------------------------------------------#
+def _write_chunk(destination, digest, chunk):
+    destination.write(chunk)
+    digest.update(chunk)
+
+
+#------------------------------------------------------------------------------#
+async def _sleep(seconds, token):
+    # Sleep, but do not continue if cancelled meanwhile
+    if token is not None:
+        token.check()
+    if seconds > 0:
+        await asyncio.sleep(seconds)
+        if token is not None:
+            token.check()
+
+
+#------------------------------------------------------------------------------#
+async def open_url(url, file=None, headers=None, token=None, traffic=TRAFFIC_INTERACTIVE):
+    host = urllib.parse.urlsplit(url).hostname
+    for attempt in range(RETRIES + 1):
+        # If download is not needed anymore
+        if token is not None:
+            token.check()
+        # If host has been failing lately, do not even try it
+        BREAKERS.check(host)
+        try:
+            respond = await _request_url(url, file, headers, token, traffic)
+        except urllib.error.URLError as e:
+            if not _is_failure(host, e, attempt):
+                raise
+        else:
+            BREAKERS.success(host)
+            return respond
+        # Wait a random, exponentially growing time before trying again
+        await _sleep(_get_retry_delay(attempt), token)
+
+
+#------------------------------------------------------------------------------#
+async def _request_url(url, file, headers, token, traffic):
+    headers, offset = await _on_disk(_get_request_headers, url, file, headers)
+    source = url
+    for _ in range(MAX_REDIRECTS):
+        async with CONNECTIONS.open(url, headers) as respond:
+            # If respond has to be saved
+            if file and respond.status < 300:
+                await _save_respond(respond, file, source, offset, token, traffic)
+                return
+            location = respond.getheader('Location')
+            # Read the full body, so the connection can be reused
+            decoder = CoubletContentDecoder(respond.getheader('Content-Encoding'))
+            while True:
+                chunk = await respond.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                decoder.decompress(chunk)
+                await _sleep(BANDWIDTH.reserve(traffic, len(chunk)), token)
+            data = decoder.flush()
+        # If respond is a redirection, follow it
+        if respond.status in REDIRECTS and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        # If partial file cannot be continued, start over
+        if respond.status == 416 and offset:
+            offset = await _on_disk(_restart_partial, file, headers)
+            continue
+        # Return file-like object
+        return _get_respond(url, respond, data)
+    raise urllib.error.URLError('too many redirections')
+
+
+#------------------------------------------------------------------------------#
+async def _save_respond(respond, file, url, offset, token, traffic):
+    part, mode, size, length, resumable, digest = await _on_disk(_start_save, respond,
+                                                                 file, url, offset)
+    try:
+        # Copy body chunk by chunk into a temporary file, and hash it
+        destination = await _on_disk(open, part, mode)
+        try:
+            while True:
+                # If download is not needed anymore
+                if token is not None:
+                    token.check()
+                chunk = await respond.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                await _on_disk(_write_chunk, destination, digest, chunk)
+                size += len(chunk)
+                await _sleep(BANDWIDTH.reserve(traffic, len(chunk)), token)
+        finally:
+            await _on_disk(destination.close)
+        await _on_disk(_finish_save, file, url, size, length, digest)
+    except BaseException as e:
+        await _on_disk(_abort_save, file, e, size, resumable)
+        raise
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletAsyncRespond:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, reader, version, status, reason, headers):
+        # Store static values
+        self._reader = reader
+        self.status = status
+        self.reason = reason
+        self.msg = headers
+
+        # Get the framing of the body
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self._chunk_left = 0
+        length = headers.get('Content-Length')
+        if self._chunked or length is None:
+            self._length = None
+        else:
+            self._length = int(length)
+        # If there is no body at all
+        if status in (204, 304) or 100 <= status < 200:
+            self._length = 0
+        self._closed = self._length == 0
+
+        # If connection cannot be reused after this respond
+        connection = headers.get('Connection', '').lower()
+        self.will_close = (connection == 'close' or
+                           (version == 'HTTP/1.0' and connection != 'keep-alive') or
+                           (self._length is None and not self._chunked))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def isclosed(self):
+        return self._closed
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def read(self, amount=None):
+        # If connection failed, report it as the urllib would
+        try:
+            return await self._read_body(amount)
+        except (OSError, EOFError, ValueError, http.client.HTTPException) as e:
+            raise urllib.error.URLError(e)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _read_body(self, amount):
+        # If the whole body is needed
+        if amount is None:
+            chunks = []
+            while True:
+                chunk = await self._read_body(CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        # If body has been consumed
+        if self._closed:
+            return b''
+        # If body is sent in chunks
+        if self._chunked:
+            return await self._read_chunk(amount)
+        # If body has a fixed length
+        if self._length is not None:
+            data = await self._read(min(amount, self._length))
+            if not data:
+                raise http.client.IncompleteRead(b'', self._length)
+            self._length -= len(data)
+            self._closed = not self._length
+            return data
+        # If body lasts until the connection is closed
+        data = await self._read(amount)
+        self._closed = not data
+        return data
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _read_chunk(self, amount):
+        reader = self._reader
+        # If a new chunk starts, get its size
+        if not self._chunk_left:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            self._chunk_left = int(line.split(b';', 1)[0], 16)
+            # If it was the last chunk, skip the trailers
+            if not self._chunk_left:
+                while (await asyncio.wait_for(reader.readline(),
+                                              READ_TIMEOUT)) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._closed = True
+                return b''
+        data = await self._read(min(amount, self._chunk_left))
+        if not data:
+            raise http.client.IncompleteRead(b'', self._chunk_left)
+        self._chunk_left -= len(data)
+        # If chunk is finished, skip its line-ending
+        if not self._chunk_left:
+            await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+        return data
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _read(self, amount):
+        return await asyncio.wait_for(self._reader.read(amount), READ_TIMEOUT)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletAsyncConnectionPool:
+
+    PORTS = {'http': 80, 'https': 443}
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, per_host):
+        # Store static values
+        self._per_host = per_host
+        # Create storages
+        self._idle  = {}
+        self._slots = {}
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    @contextlib.asynccontextmanager
+    async def open(self, url, headers):
+        # Split URL into the parts of the connection and the request
+        parts = urllib.parse.urlsplit(url)
+        try:
+            key = parts.scheme, parts.hostname, parts.port or self.PORTS[parts.scheme]
+        except KeyError:
+            raise urllib.error.URLError('unknown url type: {!r}'.format(parts.scheme))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = self._get_request(path, parts.netloc, headers)
+
+        # Wait for a free slot on this host
+        try:
+            slot = self._slots[key]
+        except KeyError:
+            slot = self._slots[key] = asyncio.Semaphore(self._per_host)
+        async with slot:
+            connection = None
+            try:
+                # Send request through an idle connection, or if that has been
+                # closed by the server in the meantime, through a brand new one
+                try:
+                    try:
+                        connection, reused = self._idle[key].pop(), True
+                    except (KeyError, IndexError):
+                        connection, reused = await self._connect(key), False
+                    try:
+                        respond = await self._request(connection, request)
+                    except (OSError, EOFError, http.client.HTTPException):
+                        connection[1].close()
+                        if not reused:
+                            raise
+                        connection = await self._connect(key)
+                        respond = await self._request(connection, request)
+                # If connection failed, report it as the urllib would
+                except (OSError, EOFError, ValueError, http.client.HTTPException) as e:
+                    raise urllib.error.URLError(e)
+
+                # The body is read by the caller, which reports the failures of
+                # the connection, and lets anything else (like a full disk) through
+                yield respond
+
+                # If the body has been consumed and the server
+                # did not ask for closing, keep connection alive
+                if respond.isclosed() and not respond.will_close:
+                    self._idle.setdefault(key, []).append(connection)
+                    connection = None
+            finally:
+                if connection:
+                    connection[1].close()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def close(self):
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_request(self, path, host, headers):
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host)]
+        lines.extend('{}: {}'.format(*header) for header in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context),
+                                      CONNECT_TIMEOUT)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _request(self, connection, request):
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        while True:
+            # Read status line
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if not line:
+                raise http.client.RemoteDisconnected('Remote end closed connection')
+            version, status, reason = (line.decode('latin-1').rstrip('\r\n') + ' ').split(' ', 2)
+            # Read headers
+            head = []
+            while True:
+                line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+                head.append(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            # Skip informational responds
+            if status != '100':
+                break
+        headers = http.client.parse_headers(io.BytesIO(b''.join(head)))
+        return CoubletAsyncRespond(reader, version, int(status), reason.strip(), headers)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletAsyncDownloadManager:
+
+    # NOTE: The loop is run by run_forever() in a thread of its own, other
+    #       threads are only touching the waiting jobs, and are asking the
+    #       loop to start them by call_soon_threadsafe()
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, concurrency):
+        # Store static values
+        self._count = concurrency
+        # Create storages
+        self._jobs = []
+        self._order = itertools.count()
+        self._running = 0
+        self._lock = threading.Lock()
+        # Create a loop, which is started by the first job
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_workers(self, count):
+        with self._lock:
+            self._count = count
+        self._wake()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def close(self):
+        # Stop the loop, close the idle connections (in the thread
+        # of the loop, as they belong to it) and the loop itself
+        with self._lock:
+            thread = self._thread
+            self._thread = False
+        if thread:
+            self._loop.call_soon_threadsafe(self._stop)
+            thread.join()
+        self._loop.close()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def submit(self, *jobs):
+        # Schedule jobs by their priorities, and keep
+        # the order of submission among the equal ones
+        with self._lock:
+            for job in jobs:
+                heapq.heappush(self._jobs, (job.priority, next(self._order), job))
+        self._wake()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def reprioritise(self, rank):
+        # Update priorities of waiting jobs by rank(job)
+        with self._lock:
+            jobs = self._jobs
+            for i, (_, order, job) in enumerate(jobs):
+                job.priority = rank(job)
+                jobs[i] = job.priority, order, job
+            heapq.heapify(jobs)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_pending(self, key):
+        # Return True if a job of key is waiting or running
+        with self._lock:
+            return _is_pending(self._jobs, key)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _wake(self):
+        # Start the thread of the loop if this is the first time,
+        # and let the loop start the jobs (unless it has been closed)
+        with self._lock:
+            if self._thread is False:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                daemon=True)
+                self._thread.start()
+            self._loop.call_soon_threadsafe(self._dispatch)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _stop(self):
+        CONNECTIONS.close()
+        self._loop.stop()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _dispatch(self):
+        # Start the most important jobs while there are free slots
+        with self._lock:
+            while self._jobs and self._running < self._count:
+                self._running += 1
+                self._loop.create_task(self._run(heapq.heappop(self._jobs)[2]))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def _run(self, job):
+        try:
+            if job.token is not None:
+                job.token.check()
+            # If the same transfer is running already, the
+            # job will be finished by that, so nothing to do
+            if FLIGHTS.join(job):
+                await job.run_async(open_url)
+        # If job is not needed anymore, put it aside, or if it
+        # has been resumed in the meantime, schedule it again
+        except CoubletCancelled:
+            # If job was doing the transfer, let a waiting one take over
+            self.submit(*FLIGHTS.land(job))
+            job = job.token.suspend(job)
+            if job:
+                self.submit(job)
+        except Exception as e:
+            self.submit(*FLIGHTS.land(job))
+            print('[ ERROR ] {}.run_async(): {!r}'.format(type(job).__name__, e))
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+
+
+#------------------------------------------------------------------------------#
+# Global connection pool and download manager objects
+CONNECTIONS = CoubletAsyncConnectionPool(CONNECTIONS_PER_HOST)
+DOWNLOADS = CoubletAsyncDownloadManager(CONCURRENCY)
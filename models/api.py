@@ -23,47 +23,206 @@
 import json
 import queue
 import collections
+import urllib.parse
 import urllib.request
 
 # Import coub modules
-from models.com import CoubletDownloadJsonThread
+from models.com import (DOWNLOADS,
+                        TRAFFIC_BACKGROUND,
+                        PRIORITY_BACKGROUND,
+                        PRIORITY_FOREGROUND,
+                        CoubletDownloadJsonJob)
+
+#------------------------------------------------------------------------------#
+def _ruby_template(**kwargs):
+    # Return a function formatting ruby-like templates, where the placeholders
+    # of the keywords are built only once, and not at each formatting
+    replacements = tuple(('%{' + keyword + '}', value)
+                         for keyword, value in kwargs.items())
+    # Templates of the API have one or two placeholders
+    if len(replacements) == 1:
+        (p1, v1), = replacements
+        return lambda string: string.replace(p1, v1)
+    elif len(replacements) == 2:
+        (p1, v1), (p2, v2) = replacements
+        return lambda string: string.replace(p1, v1).replace(p2, v2)
+    def format(string):
+        for placeholder, value in replacements:
+            string = string.replace(placeholder, value)
+        return string
+    return format
+
 
 #------------------------------------------------------------------------------#
 def _ruby_format(string, **kwargs):
-    for keyword, value in kwargs.items():
-        string = string.replace('%{' + keyword + '}', value)
-    return string
+    return _ruby_template(**kwargs)(string)
+
+
+#------------------------------------------------------------------------------#
+# Extractors of the compound fields of the translation: each gets the JSON data
+# of a coub (a dict, or anything else raising AttributeError) and returns value
+_EMPTY = {}
+_small_image = _ruby_template(version='small')
+_small_video = _ruby_template(version='small', type='mp4')
+
+#- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+def _get_thumb(source):
+    # Link to thumbnail image
+    image = source.get('image_versions') or _EMPTY
+    if 'small' in image.get('versions', ()) and image.get('template'):
+        return _small_image(image['template'])
+
+
+#- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+def _get_video(source):
+    # Link to video
+    video = (source.get('file_versions') or _EMPTY).get('web') or _EMPTY
+    if (('small' in video.get('versions', ()) or 'mp4' in video.get('types', ()))
+        and video.get('template')):
+            return _small_video(video['template'])
+
+
+#- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+def _get_ratio(source):
+    # Aspect ratio of video
+    try:
+        width, height = source['dimensions']['small']
+        return float(height) / float(width)
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return 1
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletPacket:
+
+    # Fields of translated data, and of the local files
+    __slots__ = ('id', 'perma', 'perma_link', 'ratio', 'title', 'likes',
+                 'share', 'name', 'user_id', 'user_perma', 'thumb_url',
+                 'video_url', 'audio_url', 'user_url', 'thumb_file', 'video_file',
+                 'audio_file', 'user_file', 'video_local', 'audio_local',
+                 'missing', 'error')
+
+    # TODO: Add NSFW badge if necessary
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, id, perma, perma_link, ratio, title, likes, share,
+                 thumb_url, video_url, audio_url, name, user_id, user_perma,
+                 user_url):
+        # Store translated data
+        self.id = id
+        self.perma = perma
+        self.perma_link = perma_link
+        self.ratio = ratio
+        self.title = title
+        self.likes = likes
+        self.share = share
+        self.thumb_url = thumb_url
+        self.video_url = video_url
+        self.audio_url = audio_url
+        self.name = name
+        self.user_id = user_id
+        self.user_perma = user_perma
+        self.user_url = user_url
+        # Set local files, their local addresses and state of download
+        self.thumb_file = self.video_file = self.audio_file = self.user_file = None
+        self.video_local = self.audio_local = None
+        self.missing = frozenset(('video', 'audio', 'thumb', 'user'))
+        self.error = None
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    @classmethod
+    def from_json(cls, source):
+        # Translate JSON data of a coub, the compound fields are extracted by
+        # the module level extractors, the data of creator is looked up once
+        get = source.get
+        perma = get('permalink')
+        user = get('user') or _EMPTY
+        return cls(str(get('id', 0)),
+                   perma,
+                   'http://coub.com/view/' + perma if perma else 'http://coub.com',
+                   _get_ratio(source),
+                   get('title', ''),
+                   str(get('likes_count', 0)),
+                   str(get('recoubs_count', 0)),
+                   _get_thumb(source),
+                   _get_video(source),
+                   get('audio_file_url'),
+                   user.get('name', '—'),
+                   str(user.get('id', 0)),
+                   user.get('permalink'),
+                   user.get('small_avatar'))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_file(self, kind):
+        # Return URL and local path of file of kind (video, audio, thumb, user)
+        return getattr(self, kind + '_url'), getattr(self, kind + '_file')
+
 
 
 #------------------------------------------------------------------------------#
 class CoubAPI:
 
-    POST_URL   = 'http://coub.com/coubs/{}.json'
-    STREAM_URL = 'http://coub.com/api/v1/timeline/{}?page={}&per_page={}'
+    BASE_URL   = 'http://coub.com'
+    POST_URL   = '{}/coubs/{}.json'
+    STREAM_URL = '{}/api/v1/timeline/{}?page={}&per_page={}'
     STREAM_NAMES = 'featured',     'newest',              'random',              'hot'
     STREAM_SYNCS = True,           True,                  False,                 True
     STREAM_JSONS = 'explore.json', 'explore/newest.json', 'explore/random.json', 'hot.json'
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, per_page):
+    def __init__(self, per_page, downloads=DOWNLOADS, base_url=None):
         # Store static values
         self.per_page = per_page
+        self._downloads = downloads
+        # Store the address of the API (it can be a local stand-in server)
+        self._base_url = (base_url or self.BASE_URL).rstrip('/')
         # self.per_sync = per_sync
+        # Store validators of fetched data by requesters (streams or users)
+        # and by URLs, as a not-modified response means the data has not been
+        # changed since the same requester fetched it (updates are kept
+        # apart, as their results can be dropped before they are delivered)
+        self._validators = collections.defaultdict(dict)
+        self._update_validators = collections.defaultdict(dict)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_host(self):
+        return urllib.parse.urlsplit(self._base_url).hostname
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def fetch_data_to_queue(self, index, current_page, queue, conditional=False,
+                            prepare=None, per_page=None, traffic=None):
+        self._fetch_data_to_queue(index, self.STREAM_JSONS[index], current_page,
+                                  queue, conditional, prepare, per_page, traffic)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def fetch_data_to_queue(self, index, current_page, queue):
-        self._fetch_data_to_queue(self.STREAM_JSONS[index], current_page, queue)
+    def fetch_user_data_to_queue(self, user, current_page, queue,
+                                 conditional=False, prepare=None, per_page=None):
+        self._fetch_data_to_queue(user, 'user/' + user, current_page,
+                                  queue, conditional, prepare, per_page)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def fetch_user_data_to_queue(self, user, current_page, queue):
-        self._fetch_data_to_queue('user/' + user, current_page, queue)
+    def fetch_update_to_queue(self, link, queue, token=None, prepare=None, requester=None):
+        # Updates are always conditional and less important than loading
+        url = self.POST_URL.format(self._base_url, link)
+        validators = self._update_validators[requester]
+        self._downloads.submit(CoubletDownloadJsonJob(url, queue, validators,
+                                                      PRIORITY_BACKGROUND, token,
+                                                      prepare=prepare))
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def fetch_update_to_queue(self, link, queue):
-        CoubletDownloadJsonThread(self.POST_URL.format(link), queue).start()
+    def forget_updates(self, requester):
+        # If the results of updates are dropped, the validators stored by them
+        # cannot be used anymore, as the requester has not seen that data (the
+        # on-going ones are storing theirs into the dropped storage)
+        self._update_validators.pop(requester, None)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -71,7 +230,7 @@ class CoubAPI:
         try:
             # Return total number of pages and the translated packets
             return (data.get('total_pages', 0),
-                    map(self._translate_packet, data.get('coubs', ())))
+                    map(CoubletPacket.from_json, data.get('coubs', ())))
         # If data is not a parsed JSON data, but an Exception
         except AttributeError:
             raise data
@@ -88,99 +247,23 @@ class CoubAPI:
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def _fetch_data_to_queue(self, url, current_page, queue):
-        # Format STREAM_URL and start downloading JSON file
-        url = self.STREAM_URL.format(url, current_page, self.per_page)
-        CoubletDownloadJsonThread(url, queue).start()
+    def _fetch_data_to_queue(self, requester, url, current_page,
+                             queue, conditional, prepare, per_page, traffic=None):
+        # Format STREAM_URL and start downloading JSON file, the data
+        # will be prepared by the downloading thread (if it has to be)
+        url = self.STREAM_URL.format(self._base_url, url, current_page,
+                                     per_page or self.per_page)
+        # If conditional, it is a sync, which is background traffic
+        if conditional:
+            job = CoubletDownloadJsonJob(url, queue, self._validators[requester],
+                                         PRIORITY_FOREGROUND, traffic=TRAFFIC_BACKGROUND,
+                                         prepare=prepare)
+        else:
+            job = CoubletDownloadJsonJob(url, queue, traffic=traffic, prepare=prepare)
+        self._downloads.submit(job)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def _translate_packet(self, source):
         # Create new packet
-        packet = {}
-
-        # TODO: Add NSFW badge if necessary
-
-        # TODO: Make the key names more consistent in packets <= clean-up !!!
-
-        # Link to thumbnail image
-        try:
-            image = source['image_versions']
-            if 'small' not in image['versions']:
-                raise KeyError
-            ifile = _ruby_format(image['template'], version='small')
-        except KeyError:
-            ifile = None
-        packet['thumb'] = [ifile]
-
-        # Perma link
-        try:
-            perma = source['permalink']
-            perma_link = 'http://coub.com/view/' + perma
-        except KeyError:
-            perma = None
-            perma_link = 'http://coub.com'
-        packet['perma'] = perma
-        packet['perma_link'] = perma_link
-
-        # Set aspect ration
-        try:
-            width, height = source['dimensions']['small']
-            ratio = float(height) / float(width)
-        except (KeyError, ValueError):
-            ratio = 1
-        packet['ratio'] = ratio
-
-        # Link to video
-        try:
-            video = source['file_versions']['web']
-            if ('small' not in video['versions'] and
-                'mp4' not in video['types']):
-                    raise KeyError
-            vfile = _ruby_format(video['template'], version='small', type='mp4')
-        except KeyError:
-            vfile = None
-        packet['video'] = [vfile]
-
-        # Link to audio
-        packet['audio'] = source.get('audio_file_url', None)
-        # Number of likes
-        packet['likes'] = str(source.get('likes_count', 0))
-        # Number of recoubs
-        packet['share'] = str(source.get('recoubs_count', 0))
-        # Title of masterpiece ;)
-        packet['title'] = source.get('title', '')
-
-        # Avatar of creator of coub
-        try:
-            user = source['user']['small_avatar']
-        except KeyError:
-            user = None
-        packet['user'] = [user]
-
-        # Name of creator of coub
-        try:
-            name = source['user']['name']
-        except KeyError:
-            name = '—'
-        packet['name'] = name
-
-        # ID of user
-        try:
-            user_id = source['user']['id']
-        except KeyError:
-            user_id = 0
-        packet['user_id'] = str(user_id)
-
-        # Perma-link to user
-        try:
-            user_perma = source['user']['permalink']
-        except KeyError:
-            user_perma = None
-        packet['user_perma'] = user_perma
-
-        # ID of coub
-        packet['id'] = str(source.get('id', 0))
-
-        # Return new packet
-        return packet
+        return CoubletPacket.from_json(source)
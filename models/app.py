@@ -21,12 +21,23 @@
 
 # Import Python modules
 import os
+import time
 import queue
+import collections
 
 # Import Coublet modules
 from models.api import CoubAPI
 from models.cache import CACHE
-from models.com import CoubletDownloadPacketThread
+from models.proxy import PROXY
+from models.com import (BREAKERS,
+                        BANDWIDTH,
+                        DOWNLOADS,
+                        TRAFFIC_BACKGROUND,
+                        CoubletNotModified,
+                        CoubletConnectionError,
+                        CoubletCancelToken,
+                        CoubletDownloadPacket,
+                        partial_files)
 
 #------------------------------------------------------------------------------#
 class CoubletSyncMore(Exception): pass
@@ -34,41 +45,114 @@ class CoubletEmptyQueue(Exception): pass
 class CoubletNothingScheduled(Exception): pass
 class CoubletNoMoreDataToFetch(Exception): pass
 
+#------------------------------------------------------------------------------#
+class CoubletNotifyingQueue(queue.Queue):
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, notify):
+        super().__init__()
+        self._notify = notify
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def put(self, item, block=True, timeout=None):
+        # Let the listener know (from the putting thread) about the new item
+        super().put(item, block, timeout)
+        self._notify()
+
+
+
 #------------------------------------------------------------------------------#
 class CoubletAppModel:
 
     PAGE = 5
+    # Largest page of loading, number of pages which can be fetched ahead,
+    # number of posts left in stream when the next page is fetched ahead,
+    # and weights of the new values of the latency and scrolling averages
+    PAGE_MAX = 40
+    PAGES_AHEAD = 1
+    POSTS_AHEAD = 10
+    LATENCY_WEIGHT = 0.3
+    SPEED_WEIGHT = 0.3
+    # Kinds of queues the listener is notified about
+    RAW_DATA   = 'raw_data'
+    PACKETS    = 'packets'
+    LATE_FILES = 'late_files'
+    UPDATES    = 'updates'
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self):
-        # Create an API reference
-        self._api = CoubAPI(self.PAGE)
-
+    def __init__(self, downloads=DOWNLOADS, base_url=None):
+        # Store the download engine and create an API reference which uses it
+        self._downloads = downloads
+        self._api = CoubAPI(self.PAGE, downloads, base_url)
+        # Let the local media proxy download the files the player is missing
+        PROXY.set_downloads(downloads)
+        # Function called when something arrived to a queue
+        self._listener = None
 
         # Set storages
         self._load_counters          = load_counters          = []
         self._sync_counters          = sync_counters          = []
         self._packets_queues         = packets_queues         = []
+        self._late_files_queues      = late_files_queues      = []
         self._raw_data_queues        = raw_data_queues        = []
         self._raw_update_queues      = raw_update_queues      = []
         self._scheduled_data_count   = scheduled_data_count   = []
         self._scheduled_update_count = scheduled_update_count = []
+        self._scheduled_late_count   = scheduled_late_count   = []
         self._packet_ids             = packet_ids             = []
+        self._tokens                 = tokens                 = []
+        self._update_tokens          = update_tokens          = []
+        self._pages                  = pages                  = []
+        self._placed                 = placed                 = []
+        self._sessions               = sessions               = []
+        self._pages_ahead            = pages_ahead            = []
+        self._latencies              = latencies              = []
+        self._speeds                 = speeds                 = []
 
         # Set values and storages for each stream
         for stream in CoubAPI.STREAM_NAMES:
-            # Create counters as: total pages, curent_pages
-            load_counters.append([1, 1])
+            # Create counters as: total pages, curent_pages for syncing,
+            # and total posts, offset of next page for loading, as the
+            # size of pages of loading is changing
+            load_counters.append([1, 0])
             sync_counters.append([1, 1])
+            # Create buffer of the pages of loading (as queue, page size and
+            # offset of page) and counter of the pages fetched ahead in it
+            pages.append(collections.deque())
+            pages_ahead.append(0)
+            # Set averages of latency of fetching (seconds)
+            # and speed of scrolling (posts per second)
+            latencies.append(0)
+            speeds.append(0)
             # Create queues for each stream
-            raw_data_queues.append(queue.Queue())
-            raw_update_queues.append(queue.Queue())
-            packets_queues.append(queue.Queue())
+            raw_data_queues.append(self._get_queue(self.RAW_DATA, len(raw_data_queues)))
+            raw_update_queues.append(self._get_queue(self.UPDATES, len(raw_update_queues)))
+            packets_queues.append(self._get_queue(self.PACKETS, len(packets_queues)))
+            late_files_queues.append(self._get_queue(self.LATE_FILES, len(late_files_queues)))
+            # Create counters of posts placed on the top of stream (synced)
+            # and after the others (loaded), and the loading session, as: is
+            # synchronising and the number of posts placed before or (if sync)
+            # with its own posts, which are telling where its posts are
+            placed.append([0, 0])
+            sessions.append([False, 0])
             # Create currently loading packet counter
             scheduled_data_count.append(0)
             scheduled_update_count.append(0)
+            scheduled_late_count.append(0)
             # Store packet IDs per stream
             packet_ids.append(set())
+            # Create tokens to cancel downloads of stream
+            tokens.append(CoubletCancelToken())
+            update_tokens.append(CoubletCancelToken())
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_listener(self, listener):
+        # The listener is called with the kind and the stream index of the
+        # queue, each time something arrived to it -- NOTE: it is called by
+        # the downloading threads, and not by the thread of the GUI
+        self._listener = listener
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -76,21 +160,45 @@ class CoubletAppModel:
         # If synchronising stream
         if sync:
             total, current = self._sync_counters[index]
+            # If reached end of stream
+            if current > total:
+                raise CoubletNoMoreDataToFetch
+            # Start fetching data, only care about data changed since the last time
+            self._api.fetch_data_to_queue(index, current, self._raw_data_queues[index],
+                                          sync, self._prepare_page)
+        # If loading more content to stream and the
+        # next page has been fetched ahead already
+        elif self._pages_ahead[index]:
+            self._pages_ahead[index] -= 1
         # If loading more content to stream
         else:
-            total, current = self._load_counters[index]
-
-        # If there is more content to load
-        if current <= total:
-            # Start fetching data
-            self._api.fetch_data_to_queue(index, current, self._raw_data_queues[index])
-            # If this call is not part of a call-sequence
-            if first_call:
-                # Reset schedule counter
-                self._scheduled_data_count[index] = 0
-        # If reached end of stream
-        else:
-            raise CoubletNoMoreDataToFetch
+            self._fetch_page(index)
+
+        # If this call is not part of a call-sequence
+        if first_call:
+            # Reset schedule counter
+            self._scheduled_data_count[index] = 0
+            # Start a new loading session (the place of
+            # synced posts is known when they are placed)
+            self._sessions[index] = [sync, None if sync else self._placed[index][1]]
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def read_ahead(self, index, remaining, speed):
+        # Update the average speed of scrolling
+        self._speeds[index] += self.SPEED_WEIGHT*(speed - self._speeds[index])
+        # If the end of stream is close, and next page is not fetched already
+        if (remaining <= self.POSTS_AHEAD and
+            self._pages_ahead[index] < self.PAGES_AHEAD):
+                # Pages fetched ahead are not waited for yet, so
+                # they are not taking the bandwidth of the visible posts
+                try:
+                    self._fetch_page(index, TRAFFIC_BACKGROUND)
+                    self._pages_ahead[index] += 1
+                    return True
+                except CoubletNoMoreDataToFetch:
+                    pass
+        return False
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -99,22 +207,97 @@ class CoubletAppModel:
         self._scheduled_update_count[index] = len(links)
         # Start downloading data of the given perma-links
         raw_update_queue = self._raw_update_queues[index]
+        token = self._update_tokens[index] = CoubletCancelToken()
         for link in links:
-            self._api.fetch_update_to_queue(link, raw_update_queue)
+            self._api.fetch_update_to_queue(link, raw_update_queue, token,
+                                            self._api.translate_fetched_update, index)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def suspend(self, index):
+        # Stop downloading files of stream
+        self._tokens[index].cancel()
+        # Drop on-going updates of stream, and make sure
+        # the late ones will not arrive to the same queue
+        self._update_tokens[index].cancel()
+        self._raw_update_queues[index] = self._get_queue(self.UPDATES, index)
+        self._scheduled_update_count[index] = 0
+        self._api.forget_updates(index)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def resume(self, index):
+        # If stream has been suspended, continue
+        # downloading the files it has been waiting for
+        token = self._tokens[index]
+        if token.is_cancelled():
+            self._tokens[index], jobs = token.renew()
+            self._downloads.submit(*jobs)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def prioritise(self, distance):
+        # Rank downloads of posts by distance(stream index, post position)
+        def rank(job):
+            if job.tag is None:
+                return job.priority
+            return job.rank(distance(job.tag[0], self._get_position(*job.tag)))
+        self._downloads.reprioritise(rank)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_bandwidth(self, traffic, rate):
+        # Set bytes/sec budget of traffic (0 means unlimited)
+        BANDWIDTH.set_budget(traffic, rate)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_connection_pause(self):
+        # Return seconds while the API is not available
+        return BREAKERS.retry_after(self._api.get_host())
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def pull_raw_data(self, index, sync):
         # If JSON data downloaded
         try:
-            # Translate packets, and store them
-            total_pages, packets = self._api.translate_fetched_data(
-                self._raw_data_queues[index].get_nowait())
+            # Get packets prepared by the downloading thread
+            if sync:
+                counter = self._sync_counters[index]
+                data = self._raw_data_queues[index].get_nowait()
+                page_size = self.PAGE
+            # Get the oldest page of loading, so pages arrive in order
+            else:
+                counter = self._load_counters[index]
+                pages = self._pages[index]
+                try:
+                    page_queue, page_size, offset = pages[0]
+                except IndexError:
+                    raise queue.Empty
+                data = page_queue.get_nowait()
+                pages.popleft()
+
+            # If data has not been changed since the last fetch
+            if data is CoubletNotModified:
+                total_pages, packets = counter[0], ()
+            # If there was a problem during the fetching
+            elif data is CoubletConnectionError:
+                # Drop the pages after the failed one, and continue
+                # loading from the failed one, when it is requested again
+                if not sync:
+                    pages.clear()
+                    self._pages_ahead[index] = 0
+                    counter[1] = offset
+                raise data
+            else:
+                total_pages, packets = data
 
             # Update counter values
-            counter = (self._sync_counters if sync else self._load_counters)[index]
-            counter[0] = total_pages
-            counter[1] += 1
+            if sync:
+                counter[0] = total_pages
+                counter[1] += 1
+            else:
+                counter[0] = total_pages*page_size
 
             # Get local references
             packet_ids = self._packet_ids[index]
@@ -123,47 +306,30 @@ class CoubletAppModel:
             # Number of packets will be scheduled
             packet_count = 0
             packet_index = self._scheduled_data_count[index]
-            # Temporary storage for files
-            files = set()
-            # Get folder paths of local files
-            video_path, thumb_path, avatar_path = CACHE['folders']
 
             # Process each packet
-            for packet in packets:
+            for packet, cached in packets:
                 # Get unique packet ID
-                id = packet['id']
+                id = packet.id
                 # If ID is already in the stream
                 if id in packet_ids:
                     continue
                 # If either not syncronising or ID is not in the stream
                 packet_ids.add(id)
 
-                # Create video file path and store it in temporary files
-                video_file = os.path.join(video_path, id + '.mp4')
-                files.add(video_file)
-
-                # Create thumbnail file path and store it in temporary files
-                thumb_file = os.path.join(thumb_path, id + '.jpg')
-                files.add(thumb_file)
-
-                # Create avatar file path and store it in temporary files
-                avatar_url = packet['user'][0]
-                if avatar_url:
-                    ext = os.path.splitext(avatar_url)[1]
-                    user_file = os.path.join(avatar_path, packet['user_id'] + ext)
-                    files.add(user_file)
-                else:
-                    user_file = None
-
-                # Add file names to packet
-                packet['video'].append(video_file)
-                packet['thumb'].append(thumb_file)
-                packet['user'].append(user_file)
-
-                # If video file not already cached then
-                # download it and push it to the queue
-                if not os.path.isfile(video_file):
-                    CoubletDownloadPacketThread(packet_index, packet, packets_queue).start()
+                # If video or audio file not already cached then
+                # download them and push the packet to the queue
+                if not cached:
+                    # Tag the jobs by the post, so they can be ranked later
+                    tag = index, self._sessions[index], packet_index
+                    download = CoubletDownloadPacket(packet_index, packet, packets_queue, tag,
+                                                     self._tokens[index],
+                                                     self._late_files_queues[index])
+                    jobs = download.get_jobs()
+                    # Count the files which will arrive after the post
+                    self._scheduled_late_count[index] += sum(
+                        job.kind in CoubletDownloadPacket.LATE_KEYS for job in jobs)
+                    self._downloads.submit(*jobs)
                 # If cached, pushed it to queue
                 else:
                     packets_queue.put((packet_index, packet))
@@ -172,13 +338,10 @@ class CoubletAppModel:
                 packet_count += 1
                 packet_index += 1
 
-            # Store files
-            CACHE['temporary'].update(files)
-
             # If syncronising and
             if sync:
                 # If loaded maximum number of packets per page
-                if packet_count == self.PAGE:
+                if packet_count == page_size:
                     # Increase schedule count
                     self._scheduled_data_count[index] += packet_count
                     # Indicate queue is not ready yet
@@ -191,9 +354,9 @@ class CoubletAppModel:
                     self._sync_counters[index] = [1, 1]
             # If regular loading
             else:
-                # If number of loaded packets are less the preferred
-                # TODO: but what if there are no more posts left?
-                if packet_count < self.PAGE:
+                # If number of loaded packets are less the preferred,
+                # and there are more posts left (or fetched ahead)
+                if packet_count < page_size and counter[1] < counter[0]:
                     # Increase schedule count
                     self._scheduled_data_count[index] += packet_count
                     # Indicate queue is not ready yet
@@ -205,6 +368,13 @@ class CoubletAppModel:
 
             # Store scheduled packet counts
             self._scheduled_data_count[index] = packet_count
+            # The posts of the session are placed in the stream
+            placed = self._placed[index]
+            if sync:
+                placed[0] += packet_count
+                self._sessions[index][1] = placed[0]
+            else:
+                placed[1] += packet_count
             # Store and return number of scheduled packets
             return packet_count
         # If JSON data not downloaded
@@ -212,6 +382,134 @@ class CoubletAppModel:
             raise CoubletEmptyQueue
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_position(self, index, session, packet_index):
+        # Return the position of the post in the stream, where the synced
+        # posts are pushing down the ones placed before them, and the posts
+        # of a synchronisation not placed yet will be on the top of stream
+        synced = self._placed[index][0]
+        sync, placed = session
+        if not sync:
+            return synced + placed + packet_index
+        elif placed is None:
+            return packet_index
+        return synced - placed + packet_index
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _fetch_page(self, index, traffic=None):
+        # If reached end of stream
+        counter = self._load_counters[index]
+        total, offset = counter
+        if offset >= total:
+            raise CoubletNoMoreDataToFetch
+        # Start fetching the next page to its own queue
+        size = self._get_page_size(index, offset)
+        page_queue = self._get_queue(self.RAW_DATA, index)
+        self._pages[index].append((page_queue, size, offset))
+        counter[1] = offset + size
+        # Measure the latency of fetching (the data is prepared by the
+        # downloading thread, which is right after the data arrived)
+        started = time.monotonic()
+        def prepare(data):
+            latency = time.monotonic() - started
+            self._latencies[index] += self.LATENCY_WEIGHT*(latency - self._latencies[index])
+            return self._prepare_page(data)
+        self._api.fetch_data_to_queue(index, offset//size + 1, page_queue,
+                                      prepare=prepare, per_page=size, traffic=traffic)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_page_size(self, index, offset):
+        # The page should last at least until the next page arrives:
+        # fetch twice as many posts as the scrolling would pass by
+        # during a fetching, rounded up to the multiples of PAGE
+        size = self._speeds[index]*self._latencies[index]*2
+        size = min(self.PAGE_MAX, max(self.PAGE, -(-int(size)//self.PAGE)*self.PAGE))
+        # Pages are indexed by their size, so the offset of the
+        # new page has to be a multiple of it (PAGE always is)
+        while offset % size:
+            size -= self.PAGE
+        return size
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_queue(self, kind, index):
+        # Create a queue, which notifies the listener about its new items
+        def notify():
+            if self._listener is not None:
+                self._listener(kind, index)
+        return CoubletNotifyingQueue(notify)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _prepare_page(self, data):
+        # NOTE: This method is called by the downloading thread, not by the GUI
+        total_pages, packets = self._api.translate_fetched_data(data)
+        # Temporary storage for files (path, kind and post) and prepared packets
+        files = []
+        prepared = []
+        # Get folder paths of local files
+        video_path, thumb_path, avatar_path, audio_path = CACHE['folders']
+
+        # Process each packet
+        for packet in packets:
+            id = packet.id
+            # Create video file path and store it in temporary files
+            video_file = os.path.join(video_path, id + '.mp4')
+            files.append((video_file, 'video', id))
+            # Also store the files of an interrupted download
+            files.extend((file, 'video', id) for file in partial_files(video_file))
+
+            # Create thumbnail file path and store it in temporary files
+            thumb_file = os.path.join(thumb_path, id + '.jpg')
+            files.append((thumb_file, 'thumb', id))
+
+            # Create audio file path and store it in temporary files
+            audio_url = packet.audio_url
+            if audio_url:
+                ext = os.path.splitext(audio_url)[1] or '.mp3'
+                audio_file = os.path.join(audio_path, id + ext)
+                files.append((audio_file, 'audio', id))
+                files.extend((file, 'audio', id) for file in partial_files(audio_file))
+            else:
+                audio_file = None
+
+            # Create avatar file path and store it in temporary files
+            avatar_url = packet.user_url
+            if avatar_url:
+                ext = os.path.splitext(avatar_url)[1]
+                user_file = os.path.join(avatar_path, packet.user_id + ext)
+                files.append((user_file, 'user', id))
+            else:
+                user_file = None
+
+            # Add file names to packet
+            packet.video_file = video_file
+            packet.audio_file = audio_file
+            packet.thumb_file = thumb_file
+            packet.user_file = user_file
+            # Add the local addresses media is played from, as they
+            # can be played while they are still downloading
+            packet.video_local = PROXY.get_url(video_file, packet.video_url, 'video')
+            packet.audio_local = audio_file and PROXY.get_url(audio_file, audio_url, 'audio')
+
+            # Check which files are not cached yet (or not anymore)
+            packet.missing = frozenset(kind for kind in ('video', 'audio', 'thumb', 'user')
+                                       if not self._is_cached(*packet.get_file(kind)))
+            prepared.append((packet, not packet.missing))
+
+        # Store files
+        CACHE.touch(files)
+        return total_pages, prepared
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _is_cached(self, url, file):
+        # Files without URL are never downloaded
+        return not (url and file) or CACHE.resolve(file, url)
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def pull_packets(self, index):
         # If packet data downloaded
@@ -232,15 +530,38 @@ class CoubletAppModel:
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def pull_updates(self, index):
+    def pull_late_files(self, index):
+        # If a file of an already pushed packet has been downloaded
         try:
-            # Translate raw data into packet
-            packet = self._api.translate_fetched_update(
-                        self._raw_update_queues[index].get_nowait())
+            # Get kind of file, its packet and error (if any)
+            late_file = self._late_files_queues[index].get_nowait()
             # Decrease schedule counter
-            self._scheduled_update_count[index] -= 1
-            # Return packet
-            return packet
+            self._scheduled_late_count[index] -= 1
+            return late_file
+        # If file not downloaded
+        except queue.Empty:
+            # If file scheduled but not yet arrived
+            if self._scheduled_late_count[index]:
+                raise CoubletEmptyQueue
+            # If nothing scheduled
+            raise CoubletNothingScheduled
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def pull_updates(self, index):
+        try:
+            while True:
+                data = self._raw_update_queues[index].get_nowait()
+                # Decrease schedule counter
+                self._scheduled_update_count[index] -= 1
+                # If data has not been changed since the last fetch
+                if data is CoubletNotModified:
+                    continue
+                # If there was a problem during the fetching
+                if data is CoubletConnectionError:
+                    raise data
+                # Return packet translated by the downloading thread
+                return data
         # If JSON data not downloaded
         except queue.Empty:
             # If update scheduled but not yet arrived
@@ -21,21 +21,75 @@
 
 # Import Python modules
 import os
+import json
+import time
 import pickle
+import sqlite3
+import threading
+import contextlib
+import collections
 
 #------------------------------------------------------------------------------#
 class CoubletCacheFile:
 
     FILE = 'cache'
+    INDEX = 'index.sqlite'
+    # The index, and its write-ahead log and shared memory files
+    INDEX_FILES = '', '-wal', '-shm'
+    BLOBS = 'blobs'
     PATH = '.coub_cache'
-    DIRS = 'videos', 'thumbnails', 'avatars'
+    DIRS = 'videos', 'thumbnails', 'avatars', 'audio'
+    # Kinds of files stored in the folders above
+    KINDS = 'video', 'thumb', 'user', 'audio'
+    # Byte budgets of the kinds of files
+    BUDGETS = {'video': 512*1024*1024,
+               'audio': 128*1024*1024,
+               'thumb':  32*1024*1024,
+               'user' :   8*1024*1024}
+    # Eviction frees space down to this part of the budget, runs at most in
+    # every EVICT_PERIOD seconds, does not touch the files being played or
+    # downloaded (the others are downloaded again if they are needed) nor
+    # the files used in the last PROTECT seconds, and a file is kept as long
+    # as HIT_WEIGHT seconds longer each time it has been seen again
+    EVICT_LEVEL = 0.9
+    EVICT_PERIOD = 60
+    PROTECT = 10*60
+    HIT_WEIGHT = 24*60*60
+    # Values stored beside the files
+    META_KEYS = 'dimension', 'version', 'session'
+    # Parts of files not yet downloaded (see models/com.py)
+    PARTIAL = '.part', '.meta'
+    # Version of the format of rows written by this version of the app
+    SCHEMA_VERSION = 1
+    # Files are rows of the index, where the URL a file has been downloaded
+    # from and the digest of its content are set when the download is done
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT, post TEXT, '
+                                          'size INTEGER DEFAULT 0, accessed REAL DEFAULT 0, '
+                                          'session INTEGER DEFAULT 0, hits INTEGER DEFAULT 0, '
+                                          'url TEXT, digest TEXT, schema INTEGER DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS files_session ON files (session)',
+        'CREATE INDEX IF NOT EXISTS files_kind ON files (kind)',
+        'CREATE INDEX IF NOT EXISTS files_url ON files (url)',
+        'CREATE INDEX IF NOT EXISTS files_digest ON files (digest)')
+    # Columns added to the index by the later versions
+    COLUMNS = (('hits', 'INTEGER DEFAULT 0'),
+               ('url', 'TEXT'),
+               ('digest', 'TEXT'),
+               ('schema', 'INTEGER DEFAULT 0'))
+    INSERT = 'INSERT OR IGNORE INTO files (path, schema) VALUES (?, {})'.format(SCHEMA_VERSION)
+    UPDATE = ('UPDATE files SET kind = ?, post = ?, size = ?, accessed = ?, '
+              'session = ?, hits = hits + ? WHERE path = ?')
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def __init__(self):
-        # Create path string of global cache folder and cache file
+        # Create path string of global cache folder, legacy cache file and index
         self._path = path = os.path.join(os.path.expanduser('~'), self.PATH)
         self._file = os.path.join(path, self.FILE)
-        os.makedirs(self._path, exist_ok=True)
+        self._index = os.path.join(path, self.INDEX)
+        self._blobs = os.path.join(path, self.BLOBS)
+        os.makedirs(self._blobs, exist_ok=True)
 
         # Create folders for downloaded
         # cache data if it doesn`t exist
@@ -45,33 +99,78 @@ class CoubletCacheFile:
             folders.append(folder_path)
             os.makedirs(folder_path, exist_ok=True)
 
+        # Create storages of files used in this session (path: kind, post and
+        # last access), the number of times they were seen since the last
+        # save and the ones not saved yet, which are used by the downloading
+        # threads too, so they are protected by a lock, while the index is
+        # used by the writing thread too, so that is protected by another
+        self._files = {}
+        self._held = collections.Counter()
+        self._hits = collections.Counter()
+        self._dirty = set()
+        self._dirty_meta = set()
+        self._lock = threading.Lock()
+        self._index_lock = threading.RLock()
+        self._connection = None
+        # Set the flag of files added since the last eviction, and the thread
+        # writing the index in the background, with its wake up and stop flags
+        self._modified = False
+        self._writer = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        # Set the flag and the thread of checking the folders
+        self._purge_pending = False
+        self._purger = None
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def load(self, version, dimension):
-        # Load previously saved data if exists
+        # Open index, if it is corrupted, start a new one, but if it is only
+        # not available (locked, or the disk failed), do not touch it
         try:
-            with open(self._file, 'rb') as cache_file:
-                # Deserialise cache data
-                self._data = pickle.load(cache_file)
-                # If cache file's version is not the same
-                # as the app create new cache object and
-                # store the version independent data
-                if self._data['version'] < version:
-                    dimension = self._data['dimension']
-                    # Remove cached files
-                    raise FileNotFoundError
-        # If first run of app or app has been updated
-        except (FileNotFoundError, EOFError):
-            # Delete all previously cached files
-            for folder in self._folders:
-                for path in os.listdir(folder):
-                    file = os.path.join(folder, path)
-                    if os.path.isfile(file):
-                        os.remove(file)
-            # Create new cache file and set default data
-            self._data = {'temporary': set(),
-                          'dimension': dimension,
-                          'folders'  : self._folders,
-                          'version'  : version}
+            self._connection = connection = self._connect()
+            meta = dict(connection.execute('SELECT key, value FROM meta'))
+        except sqlite3.OperationalError:
+            self._close()
+            raise
+        except sqlite3.DatabaseError as e:
+            print('[ ERROR ] Cache index is corrupted: {!r}'.format(e))
+            self._close()
+            # The log of the old index would be replayed into the new one
+            for suffix in self.INDEX_FILES:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._index + suffix)
+            self._connection = connection = self._connect()
+            meta = {}
+        self._data = data = {key: json.loads(value) for key, value in meta.items()}
+
+        # If there is no index yet, but there is a cache file of an older
+        # version of the app, take over its data, and get rid of that file,
+        # and as files of the folders may not be in the index, check them
+        if not data:
+            data.update(self._load_legacy(connection))
+            self._purge_pending = True
+
+        # Folders are always the current ones
+        data['folders'] = self._folders
+        data.setdefault('dimension', dimension)
+        # Rows written by an older version are migrated, while the files are
+        # kept, and if the app has been changed, the folders are checked too
+        if self._migrate(connection):
+            self._purge_pending = True
+        # Versions are stored as JSON arrays, so they are loaded as lists, and
+        # the folders are checked only if the app has really been changed
+        version = tuple(version)
+        if tuple(data.get('version', ())) != version:
+            data['version'] = version
+            self._purge_pending = True
+        # Start a new session
+        data['session'] = data.get('session', 0) + 1
+        self._dirty_meta.update(self.META_KEYS)
+        self._flush()
+        # Save and keep folders in their budgets during the session
+        self._writer = threading.Thread(target=self._write_periodically, daemon=True)
+        self._writer.start()
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -81,44 +180,407 @@ class CoubletCacheFile:
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def __setitem__(self, key, value):
-        self._data[key] = value
+        with self._lock:
+            self._data[key] = value
+            self._dirty_meta.add(key)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def touch(self, files):
+        # Mark files (path, kind and post) as used in this session
+        # NOTE: This method is called by the downloading threads too
+        now = time.time()
+        with self._lock:
+            for path, kind, post in files:
+                self._files[path] = kind, post, now
+                self._hits[path] += 1
+                self._dirty.add(path)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def hold(self, file):
+        # Keep file from being evicted while it is used (played)
+        # NOTE: This method is called by the threads of the media proxy
+        with self._lock:
+            self._held[file] += 1
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def release(self, file):
+        # File is not used anymore (by the one holding it)
+        with self._lock:
+            self._held[file] -= 1
+            if not self._held[file]:
+                del self._held[file]
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def resolve(self, file, url):
+        # Return True if file is cached: it is downloaded from the same URL,
+        # or the content of URL is stored already (for another post or user)
+        # NOTE: This method is called by the downloading threads
+        if self._connection is None:
+            return os.path.isfile(file)
+        with self._index_lock:
+            connection = self._connection
+            row = connection.execute('SELECT url FROM files WHERE path = ?', (file,)).fetchone()
+            known = connection.execute('SELECT digest FROM files WHERE url = ? AND '
+                                       'digest IS NOT NULL LIMIT 1', (url,)).fetchone()
+        # If file is from another URL (the avatar of user has been changed)
+        if row and row[0] and row[0] != url:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file)
+        elif os.path.isfile(file):
+            return True
+        # If content of URL is stored already, use it
+        if known:
+            digest, = known
+            try:
+                self._link(self._get_blob(digest, file), file)
+            except OSError:
+                return False
+            self._record(file, url, digest)
+            return True
+        return False
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def _serialise(self):
-        # Serialise data
-        with open(self._file, 'wb') as cache_file:
-            pickle.dump(self._data, cache_file, pickle.HIGHEST_PROTOCOL)
-            print('Cache file serialised.')
+    def store(self, part, file, url, digest):
+        # Move downloaded part to file, and store its content only once
+        # NOTE: This method is called by the downloading threads
+        blob = self._get_blob(digest, file)
+        try:
+            # If the same content is stored already, use that instead
+            if os.path.isfile(blob):
+                self._link(blob, file)
+                os.remove(part)
+            else:
+                os.replace(part, file)
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(file, blob)
+        # If file system is not able to link files,
+        # keep the file, but do not share its content
+        except OSError:
+            if os.path.isfile(part):
+                os.replace(part, file)
+        if self._connection is not None:
+            self._record(file, url, digest)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def auto_save(self):
-        # Public wrapper for saving data
-        self._serialise()
+        # If nothing has been changed since the last save, there is nothing to
+        # do, otherwise let the writing thread save it, as this is called by
+        # the GUI thread, which should never wait for the disk
+        with self._lock:
+            if not (self._dirty or self._dirty_meta):
+                return
+        self._wake.set()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def purge(self):
+        # If folders have to be checked, do it in the background, this should
+        # be called after the window is drawn, as it can take a while
+        if self._purge_pending and self._purger is None:
+            self._purge_pending = False
+            self._purger = threading.Thread(target=self._purge, daemon=True)
+            self._purger.start()
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def save(self):
-        # Get local reference
-        data = self._data
+        # Stop working in the background, and wait for the on-going writes
+        self._stopped.set()
+        self._wake.set()
+        for thread in (self._writer, self._purger):
+            if thread is not None:
+                thread.join()
+        self._writer = self._purger = None
+        # Sizes of the files of this session are final by now
+        with self._lock:
+            self._dirty.update(self._files)
+        self._flush()
+        # Leave the folders in their budgets
+        self._evict(running=False)
+
 
-        # Clean up
-        data.setdefault('latest', set())
-        for file in data['latest'] - data['temporary']:
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _flush(self):
+        # Get the changes since the last save
+        with self._lock:
+            session = self._data['session']
+            files = [(path,) + self._files[path] + (self._hits[path],) for path in self._dirty]
+            meta = [(key, json.dumps(self._data[key])) for key in self._dirty_meta]
+            self._hits = collections.Counter()
+            self._dirty = set()
+            self._dirty_meta = set()
+        # If there is nothing to save
+        if not (files or meta):
+            return
+        # Get sizes of files (the not yet downloaded ones are empty)
+        new = []
+        rows = []
+        for path, kind, post, accessed, hits in files:
             try:
-                os.remove(file)
-            # The program was terminated before all files were downloaded,
-            # but the file name is already in the temporary list
-            except FileNotFoundError:
-                pass
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            new.append((path,))
+            rows.append((kind, post, size, accessed, session, hits, path))
+        # Write changed rows only, in a single transaction
+        with self._index_lock, self._connection as connection:
+            connection.executemany(self.INSERT, new)
+            connection.executemany(self.UPDATE, rows)
+            connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', meta)
+        if rows:
+            self._modified = True
+        print('Cache index saved ({} files).'.format(len(rows)))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _write_periodically(self):
+        # NOTE: This method is running in its own thread
+        while True:
+            # Wait for an auto-save, or check the budgets from time to time
+            self._wake.wait(self.EVICT_PERIOD)
+            self._wake.clear()
+            # The last save is done by the thread stopping this one
+            if self._stopped.is_set():
+                return
+            try:
+                self._flush()
+                # If files have been added, keep folders in their budgets
+                if self._modified:
+                    self._modified = False
+                    self._evict()
+            except sqlite3.Error as e:
+                print('[ ERROR ] Cache writing failed: {!r}'.format(e))
 
-        # Update values
-        data['latest'] = data['temporary']
-        data['temporary'] = set()
 
-        # Save data
-        self._serialise()
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _purge(self):
+        # NOTE: This method is running in its own thread
+        try:
+            with self._index_lock:
+                known = {path for path, in self._connection.execute('SELECT path FROM files')}
+            # Files without rows (downloaded by an older version, or the index
+            # has been rebuilt) are taken over, and evicted when they are old
+            rows = []
+            for folder, kind in zip(self._folders, self.KINDS):
+                for entry in os.scandir(folder):
+                    if self._stopped.is_set():
+                        return
+                    if (entry.path not in known and entry.is_file() and
+                        not entry.name.endswith(self.PARTIAL)):
+                            stat = entry.stat()
+                            rows.append((entry.path, kind, stat.st_size, stat.st_mtime))
+            with self._index_lock, self._connection as connection:
+                connection.executemany('INSERT OR IGNORE INTO files (path, kind, size, '
+                                       'accessed, schema) VALUES (?, ?, ?, ?, {})'.format(
+                                       self.SCHEMA_VERSION), rows)
+            # Contents which are not linked to any file anymore are removed
+            removed = 0
+            for folder in os.scandir(self._blobs):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    if self._stopped.is_set():
+                        return
+                    # The stat of the entry has no link count on Windows
+                    if not entry.is_file():
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        if os.stat(entry.path).st_nlink == 1:
+                            os.remove(entry.path)
+                            removed += 1
+        except (OSError, sqlite3.Error) as e:
+            print('[ ERROR ] Cache checking failed: {!r}'.format(e))
+            return
+        print('Cache checked ({} files taken over, {} contents removed).'.format(len(rows),
+                                                                               removed))
+        # Let the writing thread keep the folders in their budgets
+        if rows:
+            self._modified = True
+            self._wake.set()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _evict(self, running=True):
+        # Least recently and least frequently seen files go first, but the
+        # files being played, and while the app is running, the partial files
+        # of the downloads are kept
+        protected = time.time() - self.PROTECT
+        with self._lock:
+            used = set(self._held)
+        evicted = []
+        with self._index_lock:
+            connection = self._connection
+            # Files downloaded since they were saved have no size yet
+            empty = connection.execute('SELECT path FROM files WHERE size = 0 AND session = ?',
+                                       (self._data['session'],)).fetchall()
+            sizes = []
+            for path, in empty:
+                try:
+                    sizes.append((os.path.getsize(path), path))
+                except OSError:
+                    pass
+            with connection:
+                connection.executemany('UPDATE files SET size = ? WHERE path = ?', sizes)
+
+            # If a kind of files is over its budget, remove files until it
+            # fits, where the files of the same content are stored only once
+            for kind, budget in self.BUDGETS.items():
+                total, = connection.execute(
+                    'SELECT TOTAL(size) FROM (SELECT MAX(size) AS size FROM files '
+                    'WHERE kind = ? GROUP BY COALESCE(digest, path))', (kind,)).fetchone()
+                if total <= budget:
+                    continue
+                links = dict(connection.execute(
+                    'SELECT digest, COUNT(*) FROM files WHERE digest IN '
+                    '(SELECT digest FROM files WHERE kind = ?) GROUP BY digest', (kind,)))
+                for path, size, digest in connection.execute(
+                        'SELECT path, size, digest FROM files WHERE kind = ? AND accessed < ? '
+                        'ORDER BY accessed + hits*?', (kind, protected, self.HIT_WEIGHT)):
+                    if path in used or running and path.endswith(self.PARTIAL):
+                        continue
+                    try:
+                        os.remove(path)
+                    # If file has never been (or is not yet) downloaded
+                    except FileNotFoundError:
+                        pass
+                    # If file is still open by someone (on Windows)
+                    except OSError:
+                        continue
+                    evicted.append((path,))
+                    # Space is freed only if this was the last path of content
+                    if digest:
+                        links[digest] -= 1
+                        if links[digest]:
+                            continue
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(self._get_blob(digest, path))
+                    total -= size
+                    if total <= budget*self.EVICT_LEVEL:
+                        break
+            with connection:
+                connection.executemany('DELETE FROM files WHERE path = ?', evicted)
+
+        # Forget the evicted files of this session
+        with self._lock:
+            for path, in evicted:
+                self._files.pop(path, None)
+                self._dirty.discard(path)
+        if evicted:
+            print('{} files evicted from cache.'.format(len(evicted)))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _record(self, file, url, digest):
+        # Store the source and the content of file
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            size = 0
+        with self._index_lock, self._connection as connection:
+            connection.execute(self.INSERT, (file,))
+            connection.execute('UPDATE files SET size = ?, url = ?, digest = ? WHERE path = ?',
+                               (size, url, digest, file))
+        self._modified = True
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_blob(self, digest, file):
+        # Contents are stored in folders by the first characters of their digests
+        return os.path.join(self._blobs, digest[:2], digest + os.path.splitext(file)[1])
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _link(self, blob, file):
+        # Replace file with a link to blob in a single step
+        link = file + '.link'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(link)
+        os.link(blob, link)
+        os.replace(link, file)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _connect(self):
+        # Connection is used by the thread which is saving, which
+        # is not necessarily the one which opened the connection
+        connection = sqlite3.connect(self._index, check_same_thread=False)
+        # Writing ahead keeps the index intact even if the app is killed
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            # If index has been created by an older version
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(files)')}
+            for column, definition in self.COLUMNS:
+                if columns and column not in columns:
+                    connection.execute('ALTER TABLE files ADD COLUMN {} {}'.format(column,
+                                                                                  definition))
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+        return connection
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _migrate(self, connection):
+        # Bring rows of older schemas up to date, and return their number
+        # NOTE: Only the rows are changed, the files are always kept, and the
+        #       rows of newer schemas (written by a newer version) are left as
+        #       they are, as the columns known by this version are the same
+        schema = self.SCHEMA_VERSION
+        with self._index_lock, connection:
+            # Schema 0: rows of the legacy cache file may have no kind, which
+            # is given by the folder, and the others are not in the cache
+            for folder, kind in zip(self._folders, self.KINDS):
+                folder = os.path.join(folder, '')
+                connection.execute('UPDATE files SET kind = ? WHERE schema = 0 AND '
+                                   'kind IS NULL AND substr(path, 1, ?) = ?',
+                                   (kind, len(folder), folder))
+            connection.execute('DELETE FROM files WHERE schema = 0 AND kind IS NULL')
+            # All the rows are of the current schema now
+            cursor = connection.execute('UPDATE files SET schema = ? WHERE schema < ?',
+                                        (schema, schema))
+        return cursor.rowcount
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _load_legacy(self, connection):
+        # Load the pickled cache file, if exists
+        try:
+            with open(self._file, 'rb') as cache_file:
+                data = pickle.load(cache_file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print('[ ERROR ] Legacy cache file is not readable: {!r}'.format(e))
+            data = {}
+        # Files of the last session are the ones of the previous session now
+        kinds = dict(zip(self._folders, self.KINDS))
+        rows = []
+        for path in data.get('latest', set()) | data.get('temporary', set()):
+            kind = kinds.get(os.path.dirname(path))
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            rows.append((path, kind, size))
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO files (path, kind, size) '
+                                   'VALUES (?, ?, ?)', rows)
+        os.remove(self._file)
+        return {key: data[key] for key in ('dimension', 'version') if key in data}
+
 
 
 #------------------------------------------------------------------------------#
@@ -20,13 +20,52 @@
 ######################################################################## INFO ##
 
 # Import Python modules
+import io
+import os
 import json
+import time
+import zlib
+import heapq
+import asyncio
+import hashlib
+import random
+import itertools
 import threading
+import contextlib
+import http.client
 import urllib.error
-import urllib.request
+import urllib.parse
+
+# Import Coublet modules
+from models.cache import CACHE
 
 # Module level constants
 USER_AGENT = {}
+WORKERS = 4
+CONNECTIONS_PER_HOST = 4
+MAX_REDIRECTS = 5
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 600
+# Download priorities: the lower the sooner
+PRIORITY_FOREGROUND = 0
+PRIORITY_BACKGROUND = 1000
+# Traffic classes and their bandwidth budgets in bytes/sec (0 means unlimited)
+TRAFFIC_INTERACTIVE = 'interactive'
+TRAFFIC_BACKGROUND = 'background'
+BANDWIDTH_BUDGETS = {TRAFFIC_INTERACTIVE: 0,
+                     TRAFFIC_BACKGROUND : 256*1024}
+REDIRECTS = {301, 302, 303, 307, 308}
+CHUNK_SIZE = 64*1024
+PART_EXTENSION = '.part'
+META_EXTENSION = '.meta'
+# Content-encodings accepted for data which is not saved into a file
+ACCEPT_ENCODING = 'gzip, deflate'
 
 #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
 def set_user_agent(name, version):
@@ -35,75 +74,1076 @@ def set_user_agent(name, version):
 
 
 #------------------------------------------------------------------------------#
-def _open_url(url, file=None):
+def partial_files(file):
+    # Return the paths a not yet completed download of file is using
+    part = file + PART_EXTENSION
+    return part, part + META_EXTENSION
+
+
+#------------------------------------------------------------------------------#
+def _open_url(url, file=None, headers=None, token=None, traffic=TRAFFIC_INTERACTIVE):
 
     # TODO: handle connection errors, like:
     #       urllib.error.HTTPError: HTTP Error 403: Forbidden
     #       was it forbidden because the coub is private?
 
-    # TODO: probably add some timeout, and try to reconnect or something..
-    respond = urllib.request.urlopen(urllib.request.Request(url, headers=USER_AGENT))
-    # If respond has to be saved
+    host = urllib.parse.urlsplit(url).hostname
+    for attempt in range(RETRIES + 1):
+        # If download is not needed anymore
+        if token is not None:
+            token.check()
+        # If host has been failing lately, do not even try it
+        BREAKERS.check(host)
+        try:
+            respond = _request_url(url, file, headers, token, traffic)
+        except urllib.error.URLError as e:
+            if not _is_failure(host, e, attempt):
+                raise
+        else:
+            BREAKERS.success(host)
+            return respond
+        # Wait a random, exponentially growing time before trying again
+        delay = _get_retry_delay(attempt)
+        if token is None:
+            time.sleep(delay)
+        else:
+            token.sleep(delay)
+
+
+#------------------------------------------------------------------------------#
+def _is_failure(host, error, attempt):
+    # If server refused the request, it is not the host's failure
+    if isinstance(error, urllib.error.HTTPError) and error.code < 500:
+        BREAKERS.success(host)
+        return False
+    # If connection failed, timed out or the server had an error
+    BREAKERS.failure(host)
+    return attempt < RETRIES
+
+
+#------------------------------------------------------------------------------#
+def _get_retry_delay(attempt):
+    # Return a random, exponentially growing time
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE*2**attempt))
+
+
+#------------------------------------------------------------------------------#
+def _request_url(url, file, headers, token, traffic):
+    headers, offset = _get_request_headers(url, file, headers)
+    source = url
+    for _ in range(MAX_REDIRECTS):
+        with CONNECTIONS.open(url, headers) as respond:
+            # If respond has to be saved
+            if file and respond.status < 300:
+                _save_respond(respond, file, source, offset, token, traffic)
+                return
+            location = respond.getheader('Location')
+            # Read the full body, so the connection can be reused
+            decoder = CoubletContentDecoder(respond.getheader('Content-Encoding'))
+            while True:
+                chunk = _read_respond(respond)
+                if not chunk:
+                    break
+                decoder.decompress(chunk)
+                BANDWIDTH.consume(traffic, len(chunk), token)
+            # If connection has been lost before the whole body arrived
+            if respond.length:
+                raise urllib.error.URLError(
+                    http.client.IncompleteRead(b'', respond.length))
+            data = decoder.flush()
+        # If respond is a redirection, follow it
+        if respond.status in REDIRECTS and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        # If partial file cannot be continued, start over
+        if respond.status == 416 and offset:
+            offset = _restart_partial(file, headers)
+            continue
+        # Return file-like object
+        return _get_respond(url, respond, data)
+    raise urllib.error.URLError('too many redirections')
+
+
+#------------------------------------------------------------------------------#
+def _read_respond(respond):
+    # Read the next chunk of body, if connection failed, report it as the
+    # urllib would (errors of the disk are not the failures of the host)
+    try:
+        return respond.read(CHUNK_SIZE)
+    except (OSError, http.client.HTTPException) as e:
+        raise urllib.error.URLError(e)
+
+
+#------------------------------------------------------------------------------#
+def _get_request_headers(url, file, headers):
+    headers = dict(USER_AGENT, **(headers or {}))
+    offset = 0
+    # If there is a partially downloaded file, try to continue it
     if file:
-        with open(file, 'wb') as destination:
-            destination.write(respond.read())
-    # Return file-like object
-    return respond
+        offset, validator = _load_partial(file, url)
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+    # If data will be kept in memory, ask for it compressed
+    # (saved files are media, which are compressed already)
+    else:
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+    return headers, offset
+
+
+#------------------------------------------------------------------------------#
+def _get_respond(url, respond, data):
+    # If respond is an error
+    if respond.status >= 400:
+        raise urllib.error.HTTPError(url, respond.status, respond.reason,
+                                     respond.msg, None)
+    return CoubletRespond(data, respond.status, respond.msg)
+
+
+#------------------------------------------------------------------------------#
+def _load_partial(file, url):
+    part, meta = partial_files(file)
+    # Get the size and the validator of the previous download
+    try:
+        with open(meta) as meta_file:
+            info = json.load(meta_file)
+        size = os.path.getsize(part)
+    except (OSError, ValueError):
+        return 0, None
+    # If previous download is from the same source, can be
+    # continued and is not complete yet
+    if (info.get('url') == url and info.get('validator') and
+        0 < size < (info.get('length') or 0)):
+            return size, info['validator']
+    _remove_partial(file)
+    return 0, None
+
+
+#------------------------------------------------------------------------------#
+def _restart_partial(file, headers):
+    # Drop the partial file and request the whole file instead
+    _remove_partial(file)
+    del headers['Range'], headers['If-Range']
+    return 0
+
+
+#------------------------------------------------------------------------------#
+def _remove_partial(file):
+    for path in partial_files(file):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+#------------------------------------------------------------------------------#
+def _save_respond(respond, file, url, offset, token, traffic):
+    part, mode, size, length, resumable, digest = _start_save(respond, file, url, offset)
+    try:
+        # Copy body chunk by chunk into a temporary file, and hash it
+        with open(part, mode) as destination:
+            while True:
+                # If download is not needed anymore
+                if token is not None:
+                    token.check()
+                chunk = _read_respond(respond)
+                if not chunk:
+                    break
+                destination.write(chunk)
+                digest.update(chunk)
+                BANDWIDTH.consume(traffic, len(chunk), token)
+                size += len(chunk)
+        _finish_save(file, url, size, length, digest)
+    except BaseException as e:
+        _abort_save(file, e, size, resumable)
+        raise
+
+
+#------------------------------------------------------------------------------#
+def _start_save(respond, file, url, offset):
+    part, meta = partial_files(file)
+
+    # If server continues the previous download
+    if respond.status == 206:
+        try:
+            start, length = _parse_content_range(respond.getheader('Content-Range'))
+        except ValueError:
+            start = length = None
+        if start != offset:
+            _remove_partial(file)
+            raise urllib.error.URLError('invalid content range')
+        mode = 'ab'
+        # Hash the already downloaded part of file
+        digest = hashlib.sha1()
+        with open(part, 'rb') as source:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+    # If server sends the whole file
+    else:
+        offset = 0
+        length = respond.getheader('Content-Length')
+        length = int(length) if length is not None else None
+        mode = 'wb'
+        digest = hashlib.sha1()
+
+    # Only strong validators can be used to continue downloads later
+    etag = respond.getheader('ETag')
+    validator = (etag if etag and not etag.startswith('W/')
+                      else respond.getheader('Last-Modified'))
+    resumable = bool(length and validator and
+                     (respond.status == 206 or
+                      respond.getheader('Accept-Ranges', '') == 'bytes'))
+
+    # Store the length of the file for the ones reading it while it is
+    # still downloading, and what is needed to continue it if interrupted
+    if not offset:
+        with open(meta, 'w') as meta_file:
+            json.dump({'url'      : url,
+                       'length'   : length,
+                       'validator': validator if resumable else None}, meta_file)
+    return part, mode, offset, length, resumable, digest
+
+
+#------------------------------------------------------------------------------#
+def _finish_save(file, url, size, length, digest):
+    part, meta = partial_files(file)
+    # If connection has been closed before the whole body arrived
+    if length is not None and size < length:
+        raise urllib.error.URLError(http.client.IncompleteRead(b'', length - size))
+    # Move completed file to its final place, and store its content
+    CACHE.store(part, file, url, digest.hexdigest())
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(meta)
+
+
+#------------------------------------------------------------------------------#
+def _abort_save(file, error, size, resumable):
+    # Keep only what can be continued later, and if download has been
+    # cancelled, only if there are others waiting to take it over
+    if (not (resumable and size) or
+        isinstance(error, CoubletCancelled) and not FLIGHTS.is_awaited(file)):
+            _remove_partial(file)
+
+
+#------------------------------------------------------------------------------#
+def _is_pending(jobs, key):
+    # Return True if a job of key is running, or if it is waiting
+    # (in jobs: priority, order and job) and has not been cancelled
+    return FLIGHTS.is_flying(key) or any(job.key == key and
+                                         not (job.token and job.token.is_cancelled())
+                                             for _, _, job in jobs)
+
+
+#------------------------------------------------------------------------------#
+def _parse_content_range(value):
+    # Format of value is: 'bytes <start>-<end>/<length>'
+    unit, _, value = value.partition(' ')
+    span, _, length = value.partition('/')
+    start, _, end = span.partition('-')
+    if unit != 'bytes':
+        raise ValueError
+    return int(start), int(length)
+
+
+#------------------------------------------------------------------------------#
+class CoubletTokenBucket:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_rate(self, rate):
+        # Allow bursts of one second at most
+        with self._lock:
+            self._rate = rate
+            self._tokens = rate
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def reserve(self, amount):
+        # Take amount from the bucket, and return the seconds to wait
+        with self._lock:
+            # Refill bucket
+            now = time.monotonic()
+            elapsed = now - self._last
+            self._last = now
+            # If bandwidth is unlimited
+            rate = self._rate
+            if not rate:
+                return 0
+            # Take the amount even if there are not enough tokens, and
+            # let the debt be paid back by waiting outside of the lock
+            self._tokens = min(rate, self._tokens + elapsed*rate) - amount
+            return -self._tokens/rate
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def consume(self, amount, token=None):
+        delay = self.reserve(amount)
+        if delay > 0:
+            if token is None:
+                time.sleep(delay)
+            else:
+                token.sleep(delay)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletBandwidthLimiter:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, budgets):
+        # Create a separate bucket for each traffic
+        self._buckets = {traffic: CoubletTokenBucket(rate)
+                            for traffic, rate in budgets.items()}
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_budget(self, traffic, rate):
+        self._buckets[traffic].set_rate(rate)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def reserve(self, traffic, amount):
+        return self._buckets[traffic].reserve(amount)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def consume(self, traffic, amount, token=None):
+        self._buckets[traffic].consume(amount, token)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletConnectionPool:
+
+    CONNECTIONS = {'http' : http.client.HTTPConnection,
+                   'https': http.client.HTTPSConnection}
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, per_host):
+        # Store static values
+        self._per_host = per_host
+        # Create storages
+        self._idle  = {}
+        self._slots = {}
+        self._lock  = threading.Lock()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    @contextlib.contextmanager
+    def open(self, url, headers):
+        # Split URL into the parts of the connection and the request
+        parts = urllib.parse.urlsplit(url)
+        key = parts.scheme, parts.hostname, parts.port
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # Wait for a free slot on this host
+        self._get_slot(key).acquire()
+        connection = None
+        try:
+            # Send request through an idle connection, or if that has been
+            # closed by the server in the meantime, through a brand new one
+            try:
+                connection, reused = self._get_connection(key)
+                try:
+                    respond = self._request(connection, path, headers)
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    if not reused:
+                        raise
+                    connection, reused = self._new_connection(key), False
+                    respond = self._request(connection, path, headers)
+            # If connection failed, report it as the urllib would
+            except urllib.error.URLError:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                raise urllib.error.URLError(e)
+
+            # The body is read by the caller, which reports the failures of
+            # the connection, and lets anything else (like a full disk) through
+            yield respond
+
+            # If the body has been consumed and the server
+            # did not ask for closing, keep connection alive
+            if respond.isclosed() and not respond.will_close:
+                with self._lock:
+                    self._idle.setdefault(key, []).append(connection)
+                connection = None
+        finally:
+            if connection:
+                connection.close()
+            self._slots[key].release()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_slot(self, key):
+        with self._lock:
+            try:
+                return self._slots[key]
+            except KeyError:
+                slot = self._slots[key] = threading.BoundedSemaphore(self._per_host)
+                return slot
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_connection(self, key):
+        with self._lock:
+            try:
+                return self._idle[key].pop(), True
+            except (KeyError, IndexError):
+                pass
+        return self._new_connection(key), False
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _new_connection(self, key):
+        scheme, host, port = key
+        try:
+            return self.CONNECTIONS[scheme](host, port, timeout=CONNECT_TIMEOUT)
+        except KeyError:
+            raise urllib.error.URLError('unknown url type: {!r}'.format(scheme))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _request(self, connection, path, headers):
+        # If connection is new, connect and switch to the reading timeout
+        if connection.sock is None:
+            connection.connect()
+            connection.sock.settimeout(READ_TIMEOUT)
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletContentDecoder:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, encoding):
+        # Create storages
+        self._chunks = []
+        encoding = (encoding or 'identity').strip().lower()
+        # If data is gzip compressed
+        if encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # If data is deflate compressed: whether it is zlib wrapped or raw
+        # (as some servers send it) can only be decided by its first bytes
+        elif encoding == 'deflate':
+            self._decoder = None
+            self._head = b''
+        # If data is not compressed at all
+        elif encoding == 'identity':
+            self._decoder = False
+        else:
+            raise urllib.error.URLError('unknown content-encoding: {!r}'.format(encoding))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def decompress(self, chunk):
+        # If data is not compressed
+        if self._decoder is False:
+            self._chunks.append(chunk)
+            return
+        # If the kind of deflate stream is not known yet
+        if self._decoder is None:
+            self._head += chunk
+            if len(self._head) < 2:
+                return
+            chunk, self._head = self._head, b''
+            zlib_wrapped = (chunk[0] & 0x0F == 8 and
+                            (chunk[0] << 8 | chunk[1]) % 31 == 0)
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS if zlib_wrapped
+                                                              else -zlib.MAX_WBITS)
+        try:
+            self._chunks.append(self._decoder.decompress(chunk))
+        except zlib.error as e:
+            raise urllib.error.URLError(e)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def flush(self):
+        # If deflate stream was too short to decide its kind
+        if self._decoder is None:
+            if self._head:
+                raise urllib.error.URLError('truncated deflate stream')
+        # Get the remaining decompressed data
+        elif self._decoder is not False:
+            try:
+                self._chunks.append(self._decoder.flush())
+            except zlib.error as e:
+                raise urllib.error.URLError(e)
+        # Return the whole decompressed data
+        return b''.join(self._chunks)
+
 
 
 #------------------------------------------------------------------------------#
+class CoubletRespond(io.BytesIO):
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, data, status, headers):
+        super().__init__(data)
+        self.status = status
+        self.headers = headers
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletNotModified(Exception): pass
 class CoubletConnectionError(Exception): pass
+class CoubletCircuitOpen(urllib.error.URLError): pass
+class CoubletCancelled(Exception): pass
 
 #------------------------------------------------------------------------------#
-class CoubletDownloadPacketThread(threading.Thread):
+class CoubletCancelToken:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self):
+        self._jobs = []
+        self._renewal = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
 
-    FILE_KEYS = 'video', 'thumb', 'user'
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, index, packet, queue):
-        super().__init__()
+    def cancel(self):
+        self._event.set()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_cancelled(self):
+        return self._event.is_set()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def check(self):
+        if self._event.is_set():
+            raise CoubletCancelled
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def sleep(self, seconds):
+        # Sleep, but wake up as soon as cancelled
+        if self._event.wait(seconds):
+            raise CoubletCancelled
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def suspend(self, job):
+        # Keep the cancelled job, or if the token has been renewed
+        # in the meantime, hand the job over to the new token
+        with self._lock:
+            if self._renewal is None:
+                self._jobs.append(job)
+                return
+            job.token = self._renewal
+            return job
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def renew(self):
+        # Create a new token and move the suspended jobs to it
+        with self._lock:
+            self._renewal = token = CoubletCancelToken()
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            job.token = token
+        return token, jobs
+
+#------------------------------------------------------------------------------#
+class CoubletCircuitBreaker:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, threshold, cooldown, max_cooldown):
+        # Store static values
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        # Create storages: host => [failures, opened until, cooldown]
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def check(self, host):
+        with self._lock:
+            try:
+                failures, until, cooldown = state = self._hosts[host]
+            except KeyError:
+                return
+            # If circuit is closed
+            if failures < self._threshold:
+                return
+            # If circuit is still open
+            now = time.monotonic()
+            if now < until:
+                raise CoubletCircuitOpen('{!r} is not available'.format(host))
+            # If circuit is half-open, let this request through as a
+            # trial, but keep every other request out meanwhile
+            state[1] = now + cooldown
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, [0, 0, self._cooldown])
+            state[0] += 1
+            # If there were too many failures, open the circuit, and if
+            # it is not the first time, keep it open for a longer time
+            if state[0] >= self._threshold:
+                print('[ NETWORK ] {!r} is paused for {}s'.format(host, state[2]))
+                state[1] = time.monotonic() + state[2]
+                state[2] = min(2*state[2], self._max_cooldown)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def retry_after(self, host):
+        # Return seconds until the circuit of host is closed again
+        with self._lock:
+            try:
+                failures, until, cooldown = self._hosts[host]
+            except KeyError:
+                return 0
+            if failures < self._threshold:
+                return 0
+            return max(0, until - time.monotonic())
+
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletSingleFlight:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self):
+        # Create storages (key: the job doing the transfer and the waiting ones)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def join(self, job):
+        # If job cannot be shared
+        key = job.key
+        if key is None:
+            return True
+        with self._lock:
+            # If the same transfer is already running, wait for it
+            try:
+                self._flights[key][1].append(job)
+                return False
+            # If this is the first one, it will do the transfer
+            except KeyError:
+                self._flights[key] = job, []
+                return True
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_flying(self, key):
+        # Return True if the transfer of key is running
+        with self._lock:
+            return key in self._flights
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_awaited(self, key):
+        # Return True if there are jobs waiting for the transfer of key
+        with self._lock:
+            flight = self._flights.get(key)
+            return bool(flight and flight[1])
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def land(self, job):
+        # Finish transfer and return the jobs which were waiting for it, if
+        # job is the one doing the transfer (it may have never joined it)
+        with self._lock:
+            flight = self._flights.get(job.key)
+            if flight is None or flight[0] is not job:
+                return ()
+            del self._flights[job.key]
+            return tuple(flight[1])
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletDownloadWorker(threading.Thread):
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, manager):
+        super().__init__(daemon=True)
+        self._manager = manager
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def run(self):
+        manager = self._manager
+        while True:
+            job = manager.get_job()
+            # If worker has been asked to stop
+            if job is None:
+                return
+            # Keep the worker alive whatever happens to the job
+            try:
+                if job.token is not None:
+                    job.token.check()
+                # If the same transfer is running already, the job
+                # will be finished by that, so move on to the next one
+                if not FLIGHTS.join(job):
+                    continue
+                job.run()
+            # If job is not needed anymore, put it aside, or if it
+            # has been resumed in the meantime, schedule it again
+            except CoubletCancelled:
+                # If job was doing the transfer, let a waiting one take over
+                manager.submit(*FLIGHTS.land(job))
+                job = job.token.suspend(job)
+                if job:
+                    manager.submit(job)
+            except Exception as e:
+                manager.submit(*FLIGHTS.land(job))
+                print('[ ERROR ] {}.run(): {!r}'.format(type(job).__name__, e))
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletDownloadManager:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, workers):
+        # Store static values
+        self._count = workers
+        # Create storages
+        self._jobs = []
+        self._order = itertools.count()
+        self._surplus = 0
+        self._workers = []
+        self._condition = threading.Condition()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_workers(self, count):
+        with self._condition:
+            self._count = count
+            # If workers are already running, adjust their number
+            if self._workers:
+                self._adjust_workers()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def submit(self, *jobs):
+        with self._condition:
+            # Start workers at the first call only
+            if not self._workers:
+                self._adjust_workers()
+            # Schedule jobs by their priorities, and keep
+            # the order of submission among the equal ones
+            for job in jobs:
+                heapq.heappush(self._jobs, (job.priority, next(self._order), job))
+            self._condition.notify(len(jobs))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def reprioritise(self, rank):
+        # Update priorities of waiting jobs by rank(job)
+        with self._condition:
+            jobs = self._jobs
+            for i, (_, order, job) in enumerate(jobs):
+                job.priority = rank(job)
+                jobs[i] = job.priority, order, job
+            heapq.heapify(jobs)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_pending(self, key):
+        # Return True if a job of key is waiting or running
+        with self._condition:
+            return _is_pending(self._jobs, key)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_job(self):
+        # Wait for the most important job
+        with self._condition:
+            while not (self._jobs or self._surplus):
+                self._condition.wait()
+            # If there are more workers than needed, this one stops
+            if self._surplus:
+                self._surplus -= 1
+                self._workers.remove(threading.current_thread())
+                return
+            return heapq.heappop(self._jobs)[2]
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _adjust_workers(self):
+        # NOTE: Workers remove themselves when they stop, so the ones asked
+        #       to stop, but still running are kept instead of new ones
+        workers = self._workers
+        # Start new workers if there are not enough
+        while len(workers) < self._count:
+            worker = CoubletDownloadWorker(self)
+            workers.append(worker)
+            worker.start()
+        # Ask the surplus workers (any idle ones) to stop after their jobs
+        self._surplus = len(workers) - self._count
+        self._condition.notify_all()
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletDownloadPacket:
+
+    FILE_KEYS = 'video', 'audio', 'thumb', 'user'
+    # Files which are shown later than the post itself
+    LATE_KEYS = {'video', 'audio'}
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, index, packet, queue, tag=None, token=None, late_queue=None):
         self._index = index
         self._queue = queue
+        self._late_queue = late_queue
         self._packet = packet
+        self._tag = tag
+        self._token = token
+        self._lock = threading.Lock()
+
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def run(self):
-        packet = self._packet
-        # Download from URL to file
+    def get_jobs(self):
+        # Create a download job for each file
+        jobs = []
         for file_key in self.FILE_KEYS:
-            url, file = packet[file_key]
-            print('Dowloading {!r} => {!r}'.format(url, file))
-            if url and file:
-                try:
-                    _open_url(url, file)
-                except urllib.error.URLError as e:
-                    try:
-                        packet['error'] = e.reason + '@url'
-                    # When 'reason' is not a string object
-                    except TypeError:
-                        packet['error'] = '{!r} @url'.format(e.reason)
+            url, file = self._packet.get_file(file_key)
             # TODO: what happens if not url or not file ???
-            print('File {!r} has been downloaded.'.format(file))
-        # Put packet into queue
-        self._queue.put((self._index, packet))
+            if url and file and file_key in self._packet.missing:
+                jobs.append(CoubletDownloadFileJob(url, file, file_key, self,
+                                                   self._tag, self._token))
+        self._remaining = {job.kind for job in jobs}
+        # If there is a queue for the late files, the post can be shown
+        # without them, and they will be put into that queue one by one
+        if self._late_queue is not None:
+            self._late = self._remaining & self.LATE_KEYS
+        else:
+            self._late = set()
+        # If there is nothing to download before showing the post
+        if not self._remaining - self._late:
+            self._queue.put((self._index, self._packet))
+        return jobs
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def done(self, kind, error=None):
+        with self._lock:
+            # If file will be attached to the post later
+            if kind in self._late:
+                self._late_queue.put((kind, self._packet, error))
+                return
+            if error:
+                self._packet.error = error
+            self._remaining.discard(kind)
+            # If this was the last file needed, put packet into queue
+            if not self._remaining - self._late:
+                self._queue.put((self._index, self._packet))
 
 
 
 #------------------------------------------------------------------------------#
-class CoubletDownloadJsonThread(threading.Thread):
+class CoubletDownloadFileJob:
+
+    # Distances in posts: thumbnails and avatars are more important than
+    # the videos of posts just after them, but not more important than
+    # the videos of posts right at the viewport
+    RANKS = {'thumb': 0, 'user': 0, 'audio': 2, 'video': 2}
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, url, queue):
-        super().__init__()
+    def __init__(self, url, file, kind, packet, tag=None, token=None):
+        self._url = url
+        self._file = file
+        self._packet = packet
+        # Jobs saving to the same file are sharing the same transfer
+        self.key = file
+        self.kind = kind
+        self.tag = tag
+        self.token = token
+        self.traffic = TRAFFIC_INTERACTIVE
+        self.priority = self.rank(tag[-1] if tag else PRIORITY_FOREGROUND)
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def rank(self, distance):
+        # Return priority of this job, based on the distance of its post
+        return distance + self.RANKS[self.kind]
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def run(self):
+        # If file has been downloaded by another job in the meantime
+        if os.path.isfile(self._file):
+            self._done()
+            return
+        # Download from URL to file
+        print('Dowloading {!r} => {!r}'.format(self._url, self._file))
+        try:
+            _open_url(self._url, self._file, token=self.token, traffic=self.traffic)
+        # If connection failed, or file could not be written
+        except OSError as e:
+            self._done(e)
+        else:
+            self._done()
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def run_async(self, open_url):
+        # If file has been downloaded by another job in the meantime
+        if os.path.isfile(self._file):
+            self._done()
+            return
+        # Download from URL to file
+        print('Dowloading {!r} => {!r}'.format(self._url, self._file))
+        try:
+            await open_url(self._url, self._file, token=self.token, traffic=self.traffic)
+        # If connection failed, or file could not be written
+        except OSError as e:
+            self._done(e)
+        else:
+            self._done()
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _done(self, error=None):
+        # Report to the packets of this and of the jobs waiting for it
+        if error is None:
+            print('File {!r} has been downloaded.'.format(self._file))
+        # If file could not be written
+        elif not isinstance(error, urllib.error.URLError):
+            error = '{!r} @disk'.format(error)
+        else:
+            try:
+                error = error.reason + '@url'
+            # When 'reason' is not a string object
+            except TypeError:
+                error = '{!r} @url'.format(error.reason)
+        for job in (self,) + FLIGHTS.land(self):
+            job._packet.done(job.kind, error)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletDownloadJsonJob:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, url, queue, validators=None,
+                 priority=PRIORITY_FOREGROUND, token=None, traffic=None, prepare=None):
         self._url = url
         self._queue = queue
+        self._validators = validators
+        # Processing of the parsed data, done before it is put into the queue
+        self._prepare = prepare
+        # Jobs fetching the same URL are sharing the same transfer, if they
+        # are unconditional, or conditional on the same validators
+        self.key = url, None if validators is None else id(validators)
+        self.tag = None
+        self.token = token
+        self.priority = priority
+        # If not specified, less important jobs are background traffic
+        if traffic is None:
+            traffic = (TRAFFIC_BACKGROUND if priority >= PRIORITY_BACKGROUND
+                                          else TRAFFIC_INTERACTIVE)
+        self.traffic = traffic
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def run(self):
         print('Fetching JSON data ...')
         try:
-            # Put JSON file into queue
-            self._queue.put(json.loads(_open_url(self._url).read().decode('utf-8')))
+            respond = _open_url(self._url, headers=self._get_headers(),
+                                token=self.token, traffic=self.traffic)
         except (urllib.error.URLError, ConnectionResetError):
-            self._queue.put(CoubletConnectionError)
+            respond = None
+        self._done(respond)
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    async def run_async(self, open_url):
+        print('Fetching JSON data ...')
+        try:
+            respond = await open_url(self._url, headers=self._get_headers(),
+                                     token=self.token, traffic=self.traffic)
+        except (urllib.error.URLError, ConnectionResetError):
+            respond = None
+        # Parse and prepare data in a thread, so it is not blocking the loop
+        await asyncio.get_running_loop().run_in_executor(None, self._done, respond)
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_headers(self):
+        # If request is conditional, and data has been fetched before
+        headers = {}
+        validators = self._validators
+        if validators is not None and self._url in validators:
+            etag, modified = validators[self._url]
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        return headers
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _done(self, respond):
+        # If there was a problem during the fetching
+        if respond is None:
+            data = CoubletConnectionError
+        # If data has not been changed since the last fetch
+        elif respond.status == 304:
+            data = CoubletNotModified
+        # If data is new, parse JSON file
+        else:
+            try:
+                data = json.loads(respond.read().decode('utf-8'))
+            except ValueError:
+                data = CoubletConnectionError
+            else:
+                if self._validators is not None:
+                    self._validators[self._url] = (respond.headers.get('ETag'),
+                                                   respond.headers.get('Last-Modified'))
+        # Put data into the queues of this and of the jobs waiting for it
+        for job in (self,) + FLIGHTS.land(self):
+            job._queue.put(job._get_prepared(data))
         print('JSON data has been fetched.')
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_prepared(self, data):
+        # If there is nothing to prepare
+        if self._prepare is None or isinstance(data, type):
+            return data
+        # Each job prepares its own copy, so they are not sharing objects
+        try:
+            return self._prepare(data)
+        # If data is not what it should be
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print('[ ERROR ] Preparing {!r} failed: {!r}'.format(self._url, e))
+            return CoubletConnectionError
+
+
+
+#------------------------------------------------------------------------------#
+# Global circuit breaker, bandwidth limiter, single-flight,
+# connection pool and download manager objects
+BANDWIDTH = CoubletBandwidthLimiter(BANDWIDTH_BUDGETS)
+BREAKERS = CoubletCircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN)
+FLIGHTS = CoubletSingleFlight()
+CONNECTIONS = CoubletConnectionPool(CONNECTIONS_PER_HOST)
+DOWNLOADS = CoubletDownloadManager(WORKERS)
@@ -0,0 +1,342 @@
+## INFO ########################################################################
+##                                                                            ##
+##                                  COUBLET                                   ##
+##                                  =======                                   ##
+##                                                                            ##
+##          Cross-platform desktop client to follow posts from COUB           ##
+##                       Version: 0.6.93.193 (20140824)                       ##
+##                                                                            ##
+##                           File: models/proxy.py                            ##
+##                                                                            ##
+##           Designed and written by Peter Varo. Copyright (c) 2014           ##
+##             License agreement is provided in the LICENSE file              ##
+##           For more info visit: https://github.com/petervaro/coub           ##
+##                                                                            ##
+##      Copyright (c) 2014 Coub Ltd and/or its suppliers and licensors,       ##
+##    5 Themistokli Dervi Street, Elenion Building, 1066 Nicosia, Cyprus.     ##
+##         All rights reserved. COUB (TM) is a trademark of Coub Ltd.         ##
+##                              http://coub.com                               ##
+##                                                                            ##
+######################################################################## INFO ##
+
+# Import Python modules
+import os
+import json
+import time
+import hashlib
+import threading
+import http.server
+
+# Import Coublet modules
+from models.cache import CACHE
+from models.com import (CHUNK_SIZE,
+                        READ_TIMEOUT,
+                        CoubletDownloadFileJob,
+                        partial_files)
+
+# Module level constants
+PROXY_HOST = '127.0.0.1'
+# Seconds between checking a downloading file, and seconds to wait for a
+# file which is not growing (or which is not downloading at all)
+WAIT_STEP = 0.05
+WAIT_TIMEOUT = READ_TIMEOUT
+MEDIA_TYPES = {'.mp4': 'video/mp4',
+               '.mp3': 'audio/mpeg'}
+
+#------------------------------------------------------------------------------#
+def _open_media(file, fetch):
+    # Wait for the file, or for its download to start
+    part, meta = partial_files(file)
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while True:
+        # If file has been downloaded
+        try:
+            source = open(file, 'rb')
+            return source, os.fstat(source.fileno()).st_size
+        except FileNotFoundError:
+            pass
+        # If file is downloading, get its length if known
+        try:
+            source = open(part, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                with open(meta) as meta_file:
+                    length = json.load(meta_file).get('length')
+            except (OSError, ValueError):
+                length = None
+            return source, length
+        # If download has not started yet, wait as long as it is queued, and
+        # if there is no download (it has been cancelled, or the file has
+        # been evicted) let fetch() schedule one, which raises the error of
+        # that download if it has failed
+        if fetch():
+            deadline = time.monotonic() + WAIT_TIMEOUT
+        elif time.monotonic() > deadline:
+            raise FileNotFoundError(file)
+        time.sleep(WAIT_STEP)
+
+
+#------------------------------------------------------------------------------#
+def _parse_range(value, length):
+    # Format of value is: 'bytes=<start>-<end>' or 'bytes=-<suffix>'
+    unit, _, span = value.partition('=')
+    start, _, end = span.partition('-')
+    if unit.strip() != 'bytes' or ',' in span:
+        raise ValueError
+    if not start:
+        start, end = max(length - int(end), 0), length - 1
+    else:
+        start, end = int(start), min(int(end) if end else length - 1, length - 1)
+    if start > end:
+        raise ValueError
+    return start, end
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMediaProxy:
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self):
+        # Create storages (served files by keys: the file, its source and
+        # kind, the files downloaded for the player and the failed ones)
+        self._files = {}
+        self._fetches = set()
+        self._errors = {}
+        self._server = None
+        self._downloads = None
+        self._lock = threading.Lock()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_downloads(self, downloads):
+        # Set the download manager, which downloads the missing files
+        self._downloads = downloads
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_url(self, file, url=None, kind=None):
+        # Return the local address the file is served on (if the URL and kind
+        # of file is given, the file is downloaded if it is not available)
+        key = hashlib.sha1(file.encode('utf-8')).hexdigest()[:16] + os.path.splitext(file)[1]
+        with self._lock:
+            # Start serving at the first call only
+            if self._server is None:
+                self._server = server = CoubletMediaProxyServer(self)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._files[key] = file, url, kind
+            return 'http://{}:{}/{}'.format(PROXY_HOST, self._server.server_port, key)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_file(self, key):
+        # Only the registered files are served
+        with self._lock:
+            return self._files[key][0]
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def fetch(self, key):
+        # Return True if the file of key is queued or downloading, if it is
+        # not, start downloading it for the player, and return False if that
+        # is not possible (NOTE: it is called by the threads of the server)
+        with self._lock:
+            file, url, kind = self._files[key]
+            # If the last download for the player has failed, report it once
+            error = self._errors.pop(file, None)
+            if error:
+                raise FileNotFoundError(error)
+            if file in self._fetches:
+                return True
+            downloads = self._downloads
+            if downloads is None or url is None:
+                return False
+            if downloads.is_pending(file):
+                return True
+            self._fetches.add(file)
+        downloads.submit(CoubletDownloadFileJob(url, file, kind, CoubletMediaFetch(self, file)))
+        return True
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def fetched(self, file, error=None):
+        # Download for the player has been finished
+        with self._lock:
+            self._fetches.discard(file)
+            if error:
+                self._errors[file] = error
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def close(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMediaFetch:
+
+    # NOTE: This is the packet of the jobs downloading for the player
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, proxy, file):
+        self._proxy = proxy
+        self._file = file
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def done(self, kind, error=None):
+        self._proxy.fetched(self._file, error)
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMediaProxyServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def __init__(self, proxy):
+        super().__init__((PROXY_HOST, 0), CoubletMediaProxyHandler)
+        self.proxy = proxy
+
+
+
+#------------------------------------------------------------------------------#
+class CoubletMediaProxyHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def do_GET(self):
+        self._serve(body=True)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def do_HEAD(self):
+        self._serve(body=False)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def log_message(self, format, *args):
+        pass
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _serve(self, body):
+        # Get file, and keep it from being evicted while it is served
+        key = self.path.lstrip('/')
+        try:
+            file = self.server.proxy.get_file(key)
+        except KeyError:
+            self._send_not_found()
+            return
+        CACHE.hold(file)
+        try:
+            self._send(key, file, body)
+        finally:
+            CACHE.release(file)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _send(self, key, file, body):
+        # Wait for the data of file
+        try:
+            source, length = _open_media(file, lambda: self.server.proxy.fetch(key))
+        except FileNotFoundError:
+            self._send_not_found()
+            return
+
+        with source:
+            # If the length of file is not known yet, send whatever arrives
+            # until the download is finished, and close connection after it
+            if length is None:
+                self.send_response(200)
+                self.send_header('Content-Type', self._get_type(file))
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                if body:
+                    self._copy(source, file, None)
+                return
+
+            # If player asks for a part of the file only
+            start, end, status = 0, length - 1, 200
+            span = self.headers.get('Range')
+            if span and length:
+                try:
+                    start, end = _parse_range(span, length)
+                    status = 206
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(length))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            # Send headers
+            self.send_response(status)
+            self.send_header('Content-Type', self._get_type(file))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, length))
+            self.end_headers()
+
+            # Send body
+            if body and length:
+                source.seek(start)
+                self._copy(source, file, end - start + 1)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _send_not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _copy(self, source, file, remaining):
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        try:
+            while remaining is None or remaining > 0:
+                chunk = source.read(CHUNK_SIZE if remaining is None
+                                               else min(CHUNK_SIZE, remaining))
+                # If data is available already, send it
+                if chunk:
+                    self.wfile.write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    deadline = time.monotonic() + WAIT_TIMEOUT
+                    continue
+                # If length was unknown, and download has been finished
+                if (remaining is None and os.path.isfile(file) and
+                    source.tell() >= os.path.getsize(file)):
+                        return
+                # If download has not been progressing for a while
+                if time.monotonic() > deadline:
+                    self.close_connection = True
+                    return
+                # Wait for more data to arrive
+                time.sleep(WAIT_STEP)
+        # If player does not need the rest (seeking or stopped)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_type(self, file):
+        return MEDIA_TYPES.get(os.path.splitext(file)[1], 'application/octet-stream')
+
+
+
+#------------------------------------------------------------------------------#
+# Global media proxy object
+PROXY = CoubletMediaProxy()
@@ -46,11 +46,23 @@ class CoubletPostPresenter:
         return self._post
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_span(self):
+        # Return the top and the bottom of post
+        geometry = self._post.geometry()
+        return geometry.top(), geometry.bottom()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def load(self, packet):
         self._post.load(packet)
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def attach(self, kind, packet, error=None):
+        self._post.attach(kind, packet, error)
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def update(self, packet):
         self._post.update(packet)
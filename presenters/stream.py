@@ -43,6 +43,8 @@ class CoubletStreamPresenter:
         # TODO: is it possible to use an OrderedDict instead of this two ???
         self._post_presenters_by_order = []
         self._post_presenters_by_perma = {}
+        # Late files arrived before their posts
+        self._early_files = {}
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -79,6 +81,31 @@ class CoubletStreamPresenter:
         return self._post_presenters_by_perma.keys()
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_visible_range(self, top, bottom):
+        # Return the first and the last indices of the posts between top and
+        # bottom: posts are ordered from top to bottom, so search them by
+        # halving (the first one, which ends below top and the first one,
+        # which starts below bottom)
+        first = self._bisect(lambda span: span[1] >= top)
+        last = self._bisect(lambda span: span[0] > bottom) - 1
+        return (first, last) if first <= last else (0, 0)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_remaining(self, visible_range):
+        # Return the number of posts after the visible ones
+        return len(self._post_presenters_by_order) - visible_range[1] - 1
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_distance(self, position, visible_range):
+        # Return the number of posts between the
+        # post at position and the visible ones
+        first, last = visible_range
+        return max(first - position, position - last, 0)
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def push_loaded_posts(self, index, packet):
         # Get post-presenter by index
@@ -86,13 +113,26 @@ class CoubletStreamPresenter:
         # Push packet info to corresponding post-presenter
         post_presenter.load(packet)
         # Store presenter by perma-link
-        self._post_presenters_by_perma[packet['perma']] = post_presenter
+        self._post_presenters_by_perma[packet.perma] = post_presenter
+        # Attach the late files which arrived before this post
+        for kind, error in self._early_files.pop(packet.perma, ()):
+            post_presenter.attach(kind, packet, error)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def push_late_file(self, kind, packet, error):
+        # If post has been pushed already, attach file to it
+        try:
+            self._post_presenters_by_perma[packet.perma].attach(kind, packet, error)
+        # If file arrived before the post has been pulled, attach it later
+        except KeyError:
+            self._early_files.setdefault(packet.perma, []).append((kind, error))
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def push_loaded_updates(self, packet):
         # TODO: can this ever raise KeyError ???
-        self._post_presenters_by_perma[packet['perma']].update(packet)
+        self._post_presenters_by_perma[packet.perma].update(packet)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -142,3 +182,16 @@ class CoubletStreamPresenter:
         for post_presenter in self._post_presenters_by_order:
             post_presenter.reset_unseen()
 
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _bisect(self, is_below):
+        # Return the index of the first post, which is_below(span of post)
+        posts = self._post_presenters_by_order
+        low, high = 0, len(posts)
+        while low < high:
+            middle = (low + high)//2
+            if is_below(posts[middle].get_span()):
+                high = middle
+            else:
+                low = middle + 1
+        return low
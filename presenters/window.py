@@ -20,30 +20,42 @@
 ######################################################################## INFO ##
 
 # Import Python modules
-import queue
+import time
+import random
 
 # Import PyQt5 modules
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt, QTimer, QObject, pyqtSignal
 
 # Import Coublet modules
 from models.api import CoubAPI
 from views.window import CoubletWindowView
 from models.com import CoubletConnectionError
 from presenters.stream import CoubletStreamPresenter
-from models.app import (CoubletSyncMore,
+from models.app import (CoubletAppModel,
+                        CoubletSyncMore,
                         CoubletEmptyQueue,
                         CoubletNothingScheduled,
                         CoubletNoMoreDataToFetch)
 
 
+#------------------------------------------------------------------------------#
+class CoubletArrivalNotifier(QObject):
+
+    # Emitted by the downloading threads: kind of queue and index of stream
+    arrived = pyqtSignal(str, int)
+
+
+
 #------------------------------------------------------------------------------#
 class CoubletWindowPresenter:
 
     RECONNECT   = 10000
+    RECONNECT_MAX = 300000
+    RECONNECT_STEPS = 5
     AUTO_SAVE   = 40000
     AUTO_SYNC   = 60000
     AUTO_UPDATE = 90000
-    SCHEDULED_CALL = 300
+    DISTANT_STREAM = 100
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def __init__(self, app_model, app_name, *args, **kwargs):
@@ -61,12 +73,31 @@ class CoubletWindowPresenter:
         self._auto_update.setInterval(self.AUTO_UPDATE)
         self._auto_update.timeout.connect(self.update_posts)
 
-        # Create stream presenters and first-call flags storage
+        # Set connection flags
+        self._paused = False
+
+        # Set up the delivery of the arrivals of the queues of the model: the
+        # signal is emitted by the downloading threads, and the connection is
+        # always queued, so the callbacks are called by the GUI thread, after
+        # the current event (even if it was emitted by the GUI thread itself)
+        self._waiting = {}
+        self._notifier = CoubletArrivalNotifier()
+        self._notifier.arrived.connect(self._arrived, Qt.QueuedConnection)
+        app_model.set_listener(self._notifier.arrived.emit)
+
+        # Create stream presenters, first-call flags, reconnect counters,
+        # late-file pushing flags and last visible posts (time and index)
         self._first_calls = first_calls = []
+        self._reconnects = reconnects = []
+        self._pushing_late = pushing_late = []
+        self._last_visible = last_visible = []
         self._stream_presenters = stream_presenters = []
         for i, has_sync in enumerate(CoubAPI.STREAM_SYNCS):
             stream_presenters.append(CoubletStreamPresenter(self, i, has_sync))
             first_calls.append(True)
+            reconnects.append(0)
+            pushing_late.append(False)
+            last_visible.append((time.monotonic(), 0))
 
         # Load first stream
         self._active_stream_index = 0
@@ -115,15 +146,22 @@ class CoubletWindowPresenter:
             old_stream.hide_view()
             old_stream.reset_unseen_posts()
             window.remove_stream(old_index)
+            # Stop downloading for the old stream
+            self._app.suspend(old_index)
             window.hide_scroll_indicators(True, False)
             # Load new stream
             self._active_stream_index = index
+            self._app.resume(index)
             new_stream = self._stream_presenters[index]
             window.set_stream(index, new_stream.get_view())
             new_stream.show_view()
             window.set_scroll_position(new_stream.scroll_bar_position)
             window.show_scroll_indicators(CoubAPI.STREAM_SYNCS[index], True)
-            self._auto_sync.start()
+            # Restart syncing, unless the connection is paused
+            if not self._paused:
+                self._auto_sync.start()
+            # Download the posts of the new stream first
+            self.prioritise_visible_posts()
             return True
         # If selected stream is already active
         return False
@@ -170,6 +208,47 @@ class CoubletWindowPresenter:
         self._stream_presenters[self._active_stream_index].reset_unseen_posts()
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def prioritise_visible_posts(self):
+        # Get visible region of active stream
+        active = self._active_stream_index
+        streams = self._stream_presenters
+        visible = self._get_visible_range(active)
+        # Rank posts by their distances from the visible region, and
+        # put the posts of the inactive streams behind all of them
+        def distance(index, position):
+            if index == active:
+                return streams[index].get_distance(position, visible)
+            return self.DISTANT_STREAM + position
+        self._app.prioritise(distance)
+        # Fetch the next page before the end of stream is reached
+        self._read_ahead(active, visible)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _get_visible_range(self, index):
+        # Get the first and the last indices of the posts in the viewport
+        return self._stream_presenters[index].get_visible_range(
+            *self._window.get_viewport_span())
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _read_ahead(self, index, visible):
+        # Calculate speed of scrolling (posts per second)
+        now = time.monotonic()
+        then, first = self._last_visible[index]
+        self._last_visible[index] = now, visible[0]
+        speed = abs(visible[0] - first)/(now - then) if now > then else 0
+        # Let the model fetch the next page if the end of stream is close
+        stream_presenter = self._stream_presenters[index]
+        remaining = stream_presenter.get_remaining(visible)
+        self._app.read_ahead(index, remaining, speed)
+        # If the end of stream is visible, load more
+        # posts (which are probably fetched already)
+        if remaining <= 0 and not stream_presenter.load_lock:
+            self.load_posts()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def _get_posts(self, index, sync):
         # Get currently active stream
@@ -199,14 +278,20 @@ class CoubletWindowPresenter:
         try:
             # Translate raw data and download necessary files
             packet_count = self._app.pull_raw_data(index, sync)
+            # Reset reconnect counter
+            self._reconnects[index] = 0
             # Prepare stream for posts
             self._stream_presenters[index].schedule_posts(packet_count, sync)
             # Start pushing posts to stream
             QTimer.singleShot(0, lambda: self._push_posts(index, sync))
+            # Start attaching the late files (videos) to the posts
+            if not self._pushing_late[index]:
+                self._pushing_late[index] = True
+                QTimer.singleShot(0, lambda: self._push_late_files(index))
         # If queue is empty
         except CoubletEmptyQueue:
-            # Try pulling packets later
-            QTimer.singleShot(self.SCHEDULED_CALL, lambda: self._pull_posts(index, sync))
+            # Try pulling packets when they arrived
+            self._wait(CoubletAppModel.RAW_DATA, index, lambda: self._pull_posts(index, sync))
         # If there could be more
         except CoubletSyncMore:
             # Try to load more posts
@@ -214,9 +299,8 @@ class CoubletWindowPresenter:
             QTimer.singleShot(0, lambda: self._get_posts(index, sync))
         # If there were a problem during the JSON data loading
         except CoubletConnectionError:
-            QTimer.singleShot(self.RECONNECT, lambda: self._get_posts(index, sync))
-            # TODO: add some sort of connection counter and give up
-            #       at some point, and indicate this to the user
+            self._reconnect(index, lambda: self._get_posts(index, sync))
+            # TODO: indicate to the user that the connection is lost
             print('Reconnecting, as there was a problem during fetching ...')
 
 
@@ -229,13 +313,32 @@ class CoubletWindowPresenter:
                 self._stream_presenters[index].push_loaded_posts(*self._app.pull_packets(index))
         # If queue is empty but packets were scheduled
         except CoubletEmptyQueue:
-            # Try pulling packets later
-            QTimer.singleShot(self.SCHEDULED_CALL, lambda: self._push_posts(index, sync))
+            # Try pulling packets when they arrived
+            self._wait(CoubletAppModel.PACKETS, index, lambda: self._push_posts(index, sync))
         # If queue is empty and no packets were scheduled
         except CoubletNothingScheduled:
             print('Thread is finished.')
             # Release stream
             self._stream_presenters[index].load_lock = False
+            # If the new posts are not filling the stream, fetch more ahead
+            if index == self._active_stream_index:
+                self._read_ahead(index, self._get_visible_range(index))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _push_late_files(self, index):
+        # If files already in the queue
+        try:
+            # Pull from queue and attach to posts as many files as possible
+            while True:
+                self._stream_presenters[index].push_late_file(*self._app.pull_late_files(index))
+        # If queue is empty but files were scheduled
+        except CoubletEmptyQueue:
+            # Try pulling files when they arrived
+            self._wait(CoubletAppModel.LATE_FILES, index, lambda: self._push_late_files(index))
+        # If queue is empty and no files were scheduled
+        except CoubletNothingScheduled:
+            self._pushing_late[index] = False
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -247,12 +350,63 @@ class CoubletWindowPresenter:
                 self._stream_presenters[index].push_loaded_updates(self._app.pull_updates(index))
         # If queue is empty but packets were scheduled
         except CoubletEmptyQueue:
-            # Try pulling packets later
-            QTimer.singleShot(self.SCHEDULED_CALL, lambda: self._push_updates(index))
-        # If there was a problem during the JSON data loading
+            # Try pulling packets when they arrived
+            self._wait(CoubletAppModel.UPDATES, index, lambda: self._push_updates(index))
+        # If there was a problem during the JSON data loading,
+        # skip that update and continue with the others
         except CoubletConnectionError:
-            QTimer.singleShot(self.RECONNECT, lambda: self._push_updates(index))
+            self._pause_timers()
+            QTimer.singleShot(0, lambda: self._push_updates(index))
             print('[ ERROR ] _push_updates(): handled')
         # If queue is empty and no packates scheduled
         except CoubletNothingScheduled:
             print('All posts are updated.')
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _wait(self, kind, index, callback):
+        # Call back when something arrived to the queue of stream
+        self._waiting[kind, index] = callback
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _arrived(self, kind, index):
+        # If anything is waiting for this queue (if nothing is, the
+        # item will be pulled by the next regular pull of the queue)
+        try:
+            callback = self._waiting.pop((kind, index))
+        except KeyError:
+            return
+        callback()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _reconnect(self, index, callback):
+        # Wait at least until the API is available again
+        pause = self._pause_timers()
+        # Wait longer and longer after each failed attempt, and
+        # randomise it, so streams do not try at the very same time
+        count = self._reconnects[index]
+        self._reconnects[index] = min(count + 1, self.RECONNECT_STEPS)
+        delay = min(self.RECONNECT_MAX, self.RECONNECT*2**count)*random.uniform(0.5, 1)
+        QTimer.singleShot(int(max(pause*1000, delay)), callback)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _pause_timers(self):
+        # If the API has been paused after too many failures,
+        # stop the auto timers until it is available again
+        pause = self._app.get_connection_pause()
+        if pause and not self._paused:
+            self._paused = True
+            self._auto_sync.stop()
+            self._auto_update.stop()
+            QTimer.singleShot(int(pause*1000), self._resume_timers)
+        return pause
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def _resume_timers(self):
+        self._paused = False
+        self._auto_sync.start()
+        self._auto_update.start()
@@ -64,27 +64,28 @@ class CoubletPostView(QWidget):
     def load(self, packet=None):
         # Get and set dimension of content (coub)
         width = MEDIA_WIDTH
-        height = int(width*packet['ratio'])
+        height = int(width*packet.ratio)
 
         # Store static values
-        self._link = packet['perma_link']
+        self._link = packet.perma_link
 
         # Create a video player
         self._player = CoubletMediaPlayerWidget(width=width,
                                                 height=height,
-                                                thumb_file=packet['thumb'][1],
-                                                video_file=packet['video'][1],
-                                                audio_file=packet['audio'],
+                                                thumb_file=packet.thumb_file,
+                                                # Media is played through the local proxy,
+                                                # even if it is still downloading
+                                                video_url=packet.video_local,
+                                                audio_url=packet.audio_local,
                                                 loop_audio=True,
                                                 loop_video=True,
+                                                pending_text='VIDEO IS LOADING ...',
                                                 error_font=CONSTANTS['text_font_generic'],
                                                 error_color=CONSTANTS['text_color_light_selected'],
                                                 error_background=CONSTANTS['panel_color_error'])
         # If an error occured during the download
-        try:
-            self._player.set_error(packet['error'])
-        except KeyError:
-            pass
+        if packet.error:
+            self._player.set_error(packet.error)
 
         # Build GUI (style)
         self._build_gui2(packet, width, height)
@@ -124,10 +125,27 @@ class CoubletPostView(QWidget):
         self._player.set_error(message)
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def attach(self, kind, packet, error=None):
+        # If file could not be downloaded
+        if error:
+            self._player.set_error(error)
+        # If file has arrived (it is already being played through
+        # the local proxy, unless that failed before the file arrived)
+        else:
+            self._player.retry()
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def is_visible(self):
+        # If post has visible area
+        return not self.visibleRegion().isEmpty()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def kill_if_not_visible(self):
         # If post has no visible area
-        if self.visibleRegion().isEmpty():
+        if not self.is_visible():
             # Reset that post
             self.kill()
 
@@ -193,8 +211,8 @@ class CoubletPostView(QWidget):
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def update(self, packet):
-        self._likes_text.setText(packet['likes'])
-        self._share_text.setText(packet['share'])
+        self._likes_text.setText(packet.likes)
+        self._share_text.setText(packet.share)
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -248,7 +266,7 @@ class CoubletPostView(QWidget):
         # Create and add avatar if any,
         # else use the default placeholder
         avatar = QLabel()
-        avatar_image_path = packet['user'][1]
+        avatar_image_path = packet.user_file
         if avatar_image_path:
             avatar_image = QPixmap(avatar_image_path)
         else:
@@ -262,7 +280,7 @@ class CoubletPostView(QWidget):
         text_layout.setContentsMargins(*(0,)*4)
 
         # Create and add title
-        title = QLabel('“{}”'.format(packet['title']))
+        title = QLabel('“{}”'.format(packet.title))
         # TODO: wrapping properly!
         # title.setWordWrap(True)
         title.setFont(CONSTANTS['text_font_title'])
@@ -270,7 +288,7 @@ class CoubletPostView(QWidget):
         text_layout.addWidget(title)
 
         # Create and add author
-        author = QLabel('— {}'.format(packet['name']))
+        author = QLabel('— {}'.format(packet.name))
         author.setFont(CONSTANTS['text_font_author'])
         author.setPalette(CONSTANTS['text_color_dark'])
         text_layout.addWidget(author)
@@ -293,7 +311,7 @@ class CoubletPostView(QWidget):
         likes_icon = QLabel()
         likes_icon.setPixmap(CONSTANTS['icon_like'])
 
-        self._likes_text = likes_text = QLabel(packet['likes'])
+        self._likes_text = likes_text = QLabel(packet.likes)
         likes_text.setFont(CONSTANTS['text_font_numbers'])
         likes_text.setPalette(CONSTANTS['text_color_dark'])
 
@@ -311,7 +329,7 @@ class CoubletPostView(QWidget):
         share_icon = QLabel()
         share_icon.setPixmap(CONSTANTS['icon_recoub'])
 
-        self._share_text = share_text = QLabel(packet['share'])
+        self._share_text = share_text = QLabel(packet.share)
         share_text.setFont(CONSTANTS['text_font_numbers'])
         share_text.setPalette(CONSTANTS['text_color_dark'])
 
@@ -44,6 +44,8 @@ class CoubletWindowView(QWidget):
 
     SCROLL_POSITIVE = 30
     SCROLL_NEGATIVE = -SCROLL_POSITIVE
+    # Milliseconds of calm after scrolling, before the downloads are reordered
+    SCROLL_DELAY = 100
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def __init__(self, presenter, title):
@@ -57,6 +59,13 @@ class CoubletWindowView(QWidget):
         self._buttons = []
         self._stream  = None
 
+        # Set up the timer reordering the downloads, which is restarted by
+        # each step of scrolling, so it runs only when scrolling has stopped
+        self._scroll_timer = QTimer()
+        self._scroll_timer.setSingleShot(True)
+        self._scroll_timer.setInterval(self.SCROLL_DELAY)
+        self._scroll_timer.timeout.connect(self._presenter.prioritise_visible_posts)
+
         # Build GUI
         self._build_gui()
 
@@ -93,6 +102,12 @@ class CoubletWindowView(QWidget):
         self._presenter.reset_unseen_posts()
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def on_scroll_position_changed(self, value):
+        # Download the posts closest to the viewport first
+        self._scroll_timer.start()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def on_menu_button_pressed(self, index):
         # Report event to presenter
@@ -125,6 +140,14 @@ class CoubletWindowView(QWidget):
         return self._scroll_area.verticalScrollBar().sliderPosition()
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def get_viewport_span(self):
+        # Get the top and the bottom of the viewport, in the
+        # coordinates of the widget holding the posts
+        top = self._scroll_area.verticalScrollBar().value()
+        return top, top + self._scroll_area.viewport().height()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def set_scroll_position(self, value):
         # Set position of scroll bar
@@ -186,6 +209,7 @@ class CoubletWindowView(QWidget):
         posts.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         posts.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         posts.setFrameShape(QFrame.NoFrame)
+        posts.verticalScrollBar().valueChanged.connect(self.on_scroll_position_changed)
 
         # Create a main-stream widget
         main_stream = QWidget()
@@ -33,9 +33,10 @@ from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
 class CoubletMediaPlayerWidget(QWidget):
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, width, height, thumb_file, video_file, audio_file=None,
-                 loop_video=False, loop_audio=False, error_font=None,
-                 error_color=None, error_background=None, parent=None):
+    def __init__(self, width, height, thumb_file, video_url, audio_url=None,
+                 loop_video=False, loop_audio=False, pending_text=None,
+                 error_font=None, error_color=None, error_background=None,
+                 parent=None):
         super().__init__(parent)
 
         # Restrict size
@@ -54,28 +55,36 @@ class CoubletMediaPlayerWidget(QWidget):
         self._video = video = QVideoWidget(self)
         video.setFixedSize(width, height)
 
-        # Set video player file
+        # Create indicator of a video which is waiting for data
+        self._pending = pending = QLabel(pending_text or 'VIDEO PENDING', self)
+        pending.setFixedSize(width, height)
+        pending.setAlignment(Qt.AlignCenter)
+        if error_font:
+            pending.setFont(error_font)
+        if error_color:
+            pending.setPalette(error_color)
+        self._failed = False
+        self._stopped = True
+
+        # Set video player media
         self._video_player = video_player = QMediaPlayer(None, QMediaPlayer.VideoSurface)
         video_player.setVideoOutput(video)
         video_player.error.connect(lambda: self.set_error(self.get_error()))
-        video_player.setMedia(QMediaContent(QUrl.fromLocalFile(video_file)))
+        video_player.mediaStatusChanged.connect(self.on_video_player_media_status_changed)
+        self._video_url = None
+        if video_url:
+            self.set_video(video_url)
 
         # Set looping for video
         if loop_video:
             self._loop_video = False
             video_player.stateChanged.connect(self.on_video_player_state_changed)
 
-        # Set separate playe for audio file if any
-        if audio_file:
-            self._audio_player = audio_player = QMediaPlayer(None, QMediaPlayer.StreamPlayback)
-            audio_player.error.connect(lambda: self.set_error(self.get_error()))
-            # Store MediaContent, otherwise it will be GC'd after stop()
-            self._audio = QMediaContent(QUrl(audio_file))
-            audio_player.setMedia(self._audio)
-            # Ste looping for audio
-            if loop_audio:
-                self._loop_audio = False
-                audio_player.stateChanged.connect(self.on_audio_player_state_changed)
+        # Set separate player for audio file if any
+        self._volume = 100
+        self._audio_looping = loop_audio
+        if audio_url:
+            self.set_audio(audio_url)
 
         # Make sure all flags are set and
         # only the proper widgets are visible
@@ -104,8 +113,51 @@ class CoubletMediaPlayerWidget(QWidget):
             self._loop_audio = True
 
 
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def on_video_player_media_status_changed(self, status):
+        # If video is playing but waiting for data, indicate it
+        self._pending.setVisible(not (self._stopped or self._failed) and
+                                 status in (QMediaPlayer.LoadingMedia,
+                                            QMediaPlayer.StalledMedia))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_video(self, video_url):
+        # If an error is displayed already, or video is set already
+        if self._failed or video_url == self._video_url:
+            return
+        self._video_url = video_url
+        self._video_player.setMedia(QMediaContent(QUrl(video_url)))
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def set_audio(self, audio_url):
+        # If audio player has not been created yet
+        try:
+            audio_player = self._audio_player
+        except AttributeError:
+            self._audio_player = audio_player = QMediaPlayer(None)
+            audio_player.error.connect(lambda: self.set_error(self.get_error()))
+            # Set looping for audio
+            if self._audio_looping:
+                self._loop_audio = False
+                audio_player.stateChanged.connect(self.on_audio_player_state_changed)
+        # Store MediaContent, otherwise it will be GC'd after stop()
+        self._audio = QMediaContent(QUrl(audio_url))
+        audio_player.setMedia(self._audio)
+        audio_player.setVolume(self._volume)
+        # If video is already playing, join it
+        if self.state() == QMediaPlayer.PlayingState:
+            self._loop_audio = True
+            audio_player.play()
+
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def set_error(self, message):
+        # Only the first error is displayed
+        if self._failed:
+            return
+        self._failed = True
         try:
             self._loop_audio = False
         except AttributeError:
@@ -113,18 +165,48 @@ class CoubletMediaPlayerWidget(QWidget):
         self._loop_video = False
         self._video.hide()
         self._thumb.hide()
-        layout = QVBoxLayout()
-        error_msg = self._video_player.errorString()
-        error_label = QLabel(fill('ERROR: {}'.format(message.upper()), width=32))
-        if self._error_font:
-            error_label.setFont(self._error_font)
-        if self._error_color:
-            error_label.setPalette(self._error_color)
+        self._pending.hide()
+        # If this is the first error, create its label
+        try:
+            error_label = self._error_label
+        except AttributeError:
+            layout = QVBoxLayout()
+            self._error_label = error_label = QLabel()
+            if self._error_font:
+                error_label.setFont(self._error_font)
+            if self._error_color:
+                error_label.setPalette(self._error_color)
+            layout.addWidget(error_label, alignment=Qt.AlignHCenter)
+            self.setLayout(layout)
+        error_label.setText(fill('ERROR: {}'.format(message.upper()), width=32))
+        error_label.show()
         if self._error_background:
+            self._palette = self.palette()
             self.setPalette(self._error_background)
             self.setAutoFillBackground(True)
-        layout.addWidget(error_label, alignment=Qt.AlignHCenter)
-        self.setLayout(layout)
+
+
+    #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    def retry(self):
+        # If an error is displayed, remove it, and load the media again (if it
+        # is still not available, the local proxy is going to download it)
+        if not self._failed:
+            return
+        self._failed = False
+        self._error_label.hide()
+        if self._error_background:
+            self.setPalette(self._palette)
+            self.setAutoFillBackground(False)
+        self.stop()
+        video_url, self._video_url = self._video_url, None
+        self._video_player.setMedia(QMediaContent())
+        if video_url:
+            self.set_video(video_url)
+        try:
+            self._audio_player.setMedia(QMediaContent())
+            self._audio_player.setMedia(self._audio)
+        except AttributeError:
+            pass
 
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -143,6 +225,8 @@ class CoubletMediaPlayerWidget(QWidget):
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def play(self):
+        # If media could not be played, try it again
+        self.retry()
         if self._stopped:
             self._stopped = False
             self._video.show()
@@ -158,6 +242,7 @@ class CoubletMediaPlayerWidget(QWidget):
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def pause(self):
+        self._pending.hide()
         try:
             self._loop_audio = False
             self._audio_player.pause()
@@ -170,6 +255,7 @@ class CoubletMediaPlayerWidget(QWidget):
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def stop(self):
         self._stopped = True
+        self._pending.hide()
         self._thumb.show()
         self._video.hide()
         try:
@@ -188,6 +274,7 @@ class CoubletMediaPlayerWidget(QWidget):
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     def set_volume(self, volume):
+        self._volume = volume
         try:
             self._audio_player.setVolume(volume)
         except AttributeError: